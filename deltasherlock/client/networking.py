@@ -16,17 +16,19 @@ METADATA_URLS = ["http://169.254.169.254/2009-04-04/meta-data/member-url", #Open
                  "http://metadata.google.internal/computeMetadata/v1/instance/"] #GCE
 
 
-def submit_fingerprint(fingerprint: Fingerprint, endpoint_url: str, parameters: str) -> Response:
+def submit_fingerprint(fingerprint: Fingerprint, endpoint_url: str, parameters: str, compact_arrays: bool = False) -> Response:
     """
     Submit a fingerprint to a DeltaSherlock server for processing
 
     :param fingerprint: the Fingerprint object to be submitted
     :param endpoint_url: the full URL that the server should request upon completion
     :param paramaters: a custom parameter string to be provided to the server
+    :param compact_arrays: if True, send the fingerprint's array in the compact
+    base64 form (see DSEncoder). Only supported by up-to-date servers
     :returns: a Requests.Response object representing the completed query
 
     """
-    data = {'fingerprint': DSEncoder().encode(fingerprint),
+    data = {'fingerprint': DSEncoder(compact_arrays=compact_arrays).encode(fingerprint),
             'endpoint_url': endpoint_url,
             'parameters': parameters}
     return post(SERVER_URL + "/fingerprint/submit/", json=data)
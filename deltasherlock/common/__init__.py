@@ -2,3 +2,5 @@ from . import changesets
 from . import dictionaries
 from . import fingerprinting
 from . import io
+from . import normalization
+from . import quantization
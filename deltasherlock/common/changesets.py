@@ -26,19 +26,29 @@ class ChangesetRecord(object):
         self.filesize = filesize
         return
 
-    def filetree_sentence(self) -> list:
+    def filetree_sentence(self, normalizer=None) -> list:
         """
         Return the sentence this record represents in the form of a list of
         words (filetree)
+
+        :param normalizer: an optional TokenNormalizer applied to each word
         """
-        return list(filter(None, self.filename.split("/")))
+        sentence = list(filter(None, self.filename.split("/")))
+        if normalizer is not None:
+            sentence = normalizer.normalize_sentence(sentence)
+        return sentence
 
-    def neighbor_sentence(self) -> list:
+    def neighbor_sentence(self, normalizer=None) -> list:
         """
         Return the sentence this record represents in the form of a list of
         words (neighbor)
+
+        :param normalizer: an optional TokenNormalizer applied to each word
         """
-        return [basename(self.filename)] + self.neighbors
+        sentence = [basename(self.filename)] + self.neighbors
+        if normalizer is not None:
+            sentence = normalizer.normalize_sentence(sentence)
+        return sentence
 
     def find_neighbors(self):
         """
@@ -194,12 +204,13 @@ class Changeset(object):
         self.predicted_quantity = self.__predict_quantity()
         return
 
-    def get_filetree_sentences(self) -> list:
+    def get_filetree_sentences(self, normalizer=None) -> list:
         """
         Produces a list of filetree sentences (which are just lists of words)
         corresponding to all changes within the set. Can only be called after
         changeset is closed
 
+        :param normalizer: an optional TokenNormalizer applied to each word
         :return: the list of filetree sentences
         """
         # Only usable once record is closed
@@ -209,20 +220,21 @@ class Changeset(object):
         sentences = []
 
         for record in self.creations:
-            sentences.append(record.filetree_sentence())
+            sentences.append(record.filetree_sentence(normalizer))
         for record in self.modifications:
-            sentences.append(record.filetree_sentence())
+            sentences.append(record.filetree_sentence(normalizer))
         for record in self.deletions:
-            sentences.append(record.filetree_sentence())
+            sentences.append(record.filetree_sentence(normalizer))
 
         return sentences
 
-    def get_neighbor_sentences(self) -> list:
+    def get_neighbor_sentences(self, normalizer=None) -> list:
         """
         Produces a list of neighbor sentences (which are just lists of words)
         corresponding to all changes within the set. Can only be called after
         changeset is closed
 
+        :param normalizer: an optional TokenNormalizer applied to each word
         :return: the list of neighbor sentences
         """
         # Only usable once record is closed
@@ -232,11 +244,11 @@ class Changeset(object):
         sentences = []
 
         for record in self.creations:
-            sentences.append(record.neighbor_sentence())
+            sentences.append(record.neighbor_sentence(normalizer))
         for record in self.modifications:
-            sentences.append(record.neighbor_sentence())
+            sentences.append(record.neighbor_sentence(normalizer))
         for record in self.deletions:
-            sentences.append(record.neighbor_sentence())
+            sentences.append(record.neighbor_sentence(normalizer))
 
         return sentences
 
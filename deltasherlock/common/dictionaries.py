@@ -2,7 +2,14 @@
 DeltaSherlock common dictionary-related data models and helpers.
 """
 import os
+import hashlib
+from glob import glob, escape as glob_escape
 import gensim
+from deltasherlock.common.normalization import DICTIONARY_ATTRIBUTE, TokenNormalizer, \
+    get_normalizer
+
+# gensim 4 renamed Word2Vec's size parameter to vector_size
+_VECTOR_SIZE_PARAMETER = 'vector_size' if int(gensim.__version__.split('.')[0]) >= 4 else 'size'
 
 
 class SentencesFromDirectory(object):
@@ -50,15 +57,137 @@ class SentencesFromDicts(object):
                 for sentence in value:
                     yield sentence
 
+class NormalizedSentences(object):
+    """Create an iterable object that normalizes each word of another sentence iterable"""
+
+    def __init__(self, sentences, normalizer: TokenNormalizer):
+        self.sentences = sentences
+        self.normalizer = normalizer
+
+    def __iter__(self):
+        for sentence in self.sentences:
+            yield self.normalizer.normalize_sentence(sentence)
+
 
-def create_dictionary(sentences, threads=4):
+def create_dictionary(sentences, threads=4, normalizer: TokenNormalizer = None):
     """
     Create a w2v dictionary from a sentence iterable
 
     :param sentences: an iterable object (eg an array) containing the sentences
     :param threads: how many workers to make w2v use (default: 4)
+    :param normalizer: an optional TokenNormalizer applied to every word before
+    training. Its name is recorded on the dictionary so that fingerprinting
+    applies the same normalization at lookup time, so it must be registered
+    (see normalization.register_normalizer()) under that name
     :returns: the dictionary (may take a while)
     """
+    if normalizer is None:
+        normalizer = get_normalizer()
+    else:
+        try:
+            registered = get_normalizer(normalizer.name)
+        except ValueError:
+            registered = None
+        # Otherwise, lookups would silently use different rules than training
+        if registered is not normalizer and registered != normalizer:
+            raise ValueError("Token normalizer " + repr(normalizer.name)
+                             + " must be registered before building a dictionary")
+        sentences = NormalizedSentences(sentences, normalizer)
     model = gensim.models.Word2Vec(
-        sentences, size=200, workers=threads, min_count=1)
+        sentences, workers=threads, min_count=1, **{_VECTOR_SIZE_PARAMETER: 200})
+    setattr(model, DICTIONARY_ATTRIBUTE, normalizer.name)
     return model
+
+
+def create_dictionary_file(sentences, save_path: str, threads=4, normalizer: TokenNormalizer = None) -> str:
+    """
+    Create a w2v dictionary from a sentence iterable and save it to a file,
+    rather than returning it. Intended for use as an RQ job, so that the
+    (large) dictionary never has to travel through Redis
+
+    :param sentences: an iterable object (eg an array) containing the sentences
+    :param save_path: the full path of the dictionary file to be saved
+    :param threads: how many workers to make w2v use (default: 4)
+    :param normalizer: an optional TokenNormalizer (see create_dictionary())
+    :returns: the content digest of the saved dictionary
+    """
+    model = create_dictionary(sentences, threads=threads, normalizer=normalizer)
+    save_dictionary(model, save_path)
+    return dictionary_digest(save_path)
+
+
+def save_dictionary(dictionary, save_path: str):
+    """
+    Saves a w2v dictionary so that a complete dictionary is always found at
+    save_path, even if saving is interrupted. gensim may store large arrays in
+    separate .npy files, so everything is written under a temporary name first
+    and then renamed into place (main file last)
+
+    :param dictionary: the gensim Word2Vec object
+    :param save_path: the full path of the dictionary file to be saved
+    """
+    save_path = os.path.abspath(save_path)
+    partial_path = save_path + ".partial"
+    dictionary.save(partial_path)
+    for fname in glob(glob_escape(partial_path) + ".*.npy"):
+        os.replace(fname, save_path + fname[len(partial_path):])
+    os.replace(partial_path, save_path)
+
+
+# Content digests of dictionary files, keyed by path, mtime, and size, so that
+# unchanged files are only ever hashed once per process
+_digest_cache = {}
+
+# Dictionaries already loaded by this process, keyed by path and digest
+_dictionary_cache = {}
+
+
+def dictionary_digest(path: str) -> str:
+    """
+    Computes a SHA-256 content digest of a saved w2v dictionary, including any
+    arrays that gensim stored in separate .npy files alongside it
+
+    :param path: the full path to the dictionary file
+    :returns: the hex digest
+    """
+    path = os.path.abspath(path)
+    files = [path] + sorted(glob(glob_escape(path) + ".*.npy"))
+    stamp = tuple((os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    for fname in files:
+        with open(fname, 'rb') as dict_file:
+            for block in iter(lambda: dict_file.read(1 << 20), b''):
+                digest.update(block)
+    _digest_cache[path] = (stamp, digest.hexdigest())
+    return _digest_cache[path][1]
+
+
+def load_dictionary(path: str, digest: str = None, mmap: str = 'r'):
+    """
+    Load a saved w2v dictionary, reusing the copy already loaded by this process
+    if the file has not changed. Large arrays are memory-mapped by default, so
+    processes loading the same file share its pages
+
+    :param path: the full path to the dictionary file
+    :param digest: the expected content digest (see dictionary_digest()). If
+    provided and the file no longer matches it, a ValueError is raised
+    :param mmap: passed to gensim's load(). Use None to read fully into memory
+    :returns: the gensim Word2Vec object
+    """
+    path = os.path.abspath(path)
+    actual_digest = dictionary_digest(path)
+    if digest is not None and digest != actual_digest:
+        raise ValueError("Dictionary at " + path + " has changed since it was referenced")
+
+    key = (path, actual_digest)
+    if key not in _dictionary_cache:
+        # Drop any stale copy of this same file before loading the new one
+        for stale_key in [k for k in _dictionary_cache if k[0] == path]:
+            del _dictionary_cache[stale_key]
+        _dictionary_cache[key] = gensim.models.Word2Vec.load(path, mmap=mmap)
+    return _dictionary_cache[key]
@@ -9,6 +9,7 @@ from enum import Enum, unique
 from gensim.models import Word2Vec
 import numpy as np
 from deltasherlock.common.changesets import Changeset
+from deltasherlock.common.normalization import dictionary_normalizer
 
 
 @unique
@@ -31,10 +32,10 @@ class FingerprintingMethod(Enum):
     combined = 7
 
     def requires_filetree_dict(self):
-        return (self.value == self.filetree.value or self.value == self.histofiletree.value or self.value == self.combined.value)
+        return (self.value == self.filetree.value or self.value == self.histofiletree.value or self.value == self.filetreeneighbor.value or self.value == self.combined.value)
 
     def requires_neighbor_dict(self):
-        return (self.value == self.neighbor.value or self.value == self.histoneighbor.value or self.value == self.combined.value)
+        return (self.value == self.neighbor.value or self.value == self.histoneighbor.value or self.value == self.filetreeneighbor.value or self.value == self.combined.value)
 
 
 class Fingerprint(np.ndarray):
@@ -263,14 +264,18 @@ def __w2v_fingerprint_array(basenames: list, w2v_dictionary: Word2Vec) -> np.nda
     :returns: a NumPy array that could be used to create a Fingerprint
     """
     fingerprint_arr = np.array([0] * 200)
+    # Use the same normalization the dictionary was built with
+    normalizer = dictionary_normalizer(w2v_dictionary)
 
     for basename in basenames:
         # Clean up the basenames, just in case
         basename = basename.rstrip('\",\n').strip('[').strip(' ').strip('\"')
         basename = basename.strip('\,').rstrip(',\"').strip('\t').strip(',')
-        # Now look up each basename in the dictionary
-        if basename in w2v_dictionary:
-            fingerprint_arr = w2v_dictionary[basename] + fingerprint_arr
+        basename = normalizer.normalize(basename)
+        # Now look up each basename in the dictionary's word vectors (gensim 4
+        # only supports lookups through wv)
+        if basename in w2v_dictionary.wv:
+            fingerprint_arr = w2v_dictionary.wv[basename] + fingerprint_arr
 
     # Normalization Math
     fin = fingerprint_arr * fingerprint_arr
@@ -9,11 +9,21 @@ import random
 import string
 import time
 import json
+import hashlib
+import gzip
+import bz2
+import lzma
+from functools import partial
+from glob import glob, escape as glob_escape
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from base64 import b64encode, b64decode
 import numpy as np
 from deltasherlock.common.changesets import Changeset
 from deltasherlock.common.changesets import ChangesetRecord
 from deltasherlock.common.fingerprinting import Fingerprint
 from deltasherlock.common.fingerprinting import FingerprintingMethod
+from deltasherlock.common.quantization import QuantizedMatrix
 
 
 class DSEncoder(json.JSONEncoder):
@@ -21,8 +31,22 @@ class DSEncoder(json.JSONEncoder):
     Provides some JSON serialization facilities for custom objects used by
     DeltaSherlock (currently supports Fingerprints, Changesets, and
     ChangesetRecords). Ex. Usage: json_str = DSEncoder().encode(my_changeset)
+
+    Fingerprint arrays are written as lists of numbers by default. Pass
+    compact_arrays=True to instead write their raw little-endian bytes (base64
+    encoded) along with their dtype, which is much faster to encode and decode.
+    DSDecoder accepts either form
+
+    Similarly, pass compact_records=True to write each of a Changeset's
+    records as a [filename, mtime, neighbors, filesize] list rather than a dict.
+    This is smaller, and DSDecoder builds records straight from it
     """
 
+    def __init__(self, *args, compact_arrays: bool = False, compact_records: bool = False, **kwargs):
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+        self.compact_arrays = compact_arrays
+        self.compact_records = compact_records
+
     def default(self, o: object):
         """
         Coverts a given object into a JSON serializable object. Not to be used
@@ -39,7 +63,13 @@ class DSEncoder(json.JSONEncoder):
             serializable['method'] = o.method.value
             serializable['labels'] = o.labels
             serializable['predicted_quantity'] = o.predicted_quantity
-            serializable['array'] = o.tolist()
+            if self.compact_arrays:
+                array = np.ascontiguousarray(o).view(np.ndarray)
+                array = array.astype(array.dtype.newbyteorder('<'), copy=False)
+                serializable['dtype'] = array.dtype.str
+                serializable['array'] = b64encode(array.tobytes()).decode('ascii')
+            else:
+                serializable['array'] = o.tolist()
 
         elif (isinstance(o, Changeset)):
             serializable['type'] = "Changeset"
@@ -50,17 +80,22 @@ class DSEncoder(json.JSONEncoder):
             serializable['predicted_quantity'] = o.predicted_quantity
 
             # Rescursively serialize the file change lists
+            if self.compact_records:
+                serialize_record = self.__record_as_list
+            else:
+                serialize_record = self.default
+
             serializable['creations'] = list()
             for cs_record in o.creations:
-                serializable['creations'].append(self.default(cs_record))
+                serializable['creations'].append(serialize_record(cs_record))
 
             serializable['modifications'] = list()
             for cs_record in o.modifications:
-                serializable['modifications'].append(self.default(cs_record))
+                serializable['modifications'].append(serialize_record(cs_record))
 
             serializable['deletions'] = list()
             for cs_record in o.deletions:
-                serializable['deletions'].append(self.default(cs_record))
+                serializable['deletions'].append(serialize_record(cs_record))
 
         elif (isinstance(o, ChangesetRecord)):
             serializable['type'] = "ChangesetRecord"
@@ -75,6 +110,13 @@ class DSEncoder(json.JSONEncoder):
 
         return serializable
 
+    @staticmethod
+    def __record_as_list(record: ChangesetRecord) -> list:
+        """
+        The compact (list) form of a ChangesetRecord. Only used within Changesets
+        """
+        return [record.filename, record.mtime, record.neighbors, record.filesize]
+
 
 class DSDecoder(json.JSONDecoder):
     """
@@ -90,56 +132,106 @@ class DSDecoder(json.JSONDecoder):
     def object_hook(self, obj: dict):
         """
         Called in order to covert a newly-deserialized list back to a usable
-        object
+        object. Dicts that don't represent a DeltaSherlock object are returned
+        unchanged
 
         :param: obj the newly-deserialized list
         :returns: the corresponding DeltaSherlock object
         """
-        # Check if object is already deserialized
-
-        deserialized = None
-        #import ipdb; ipdb.set_trace()
-        if obj['type'] == "Fingerprint":
-            deserialized = Fingerprint(np.array(obj['array']))
-            deserialized.method = FingerprintingMethod(obj['method'])
-            deserialized.labels = obj['labels']
-            deserialized.predicted_quantity = obj['predicted_quantity']
-
-        elif obj['type'] == "Changeset":
-            deserialized = Changeset(obj['open_time'])
-            deserialized.open = obj['open']
-            deserialized.close_time = obj['close_time']
-            deserialized.labels = obj['labels']
-            deserialized.predicted_quantity = obj['predicted_quantity']
-            deserialized.creations = obj['creations']
-            deserialized.modifications = obj['modifications']
-            deserialized.deletions = obj['deletions']
-
-            # deserialized.creations = list()
-            # for cs_record_ser in obj['creations']:
-            #     import ipdb; ipdb.set_trace()
-            #     deserialized.creations.append(self.object_hook(cs_record_ser))
-            #
-            # deserialized.modifications = list()
-            # for cs_record_ser in obj['modifications']:
-            #     deserialized.modifications.append(self.object_hook(cs_record_ser))
-            #
-            # deserialized.deletions = list()
-            # for cs_record_ser in obj['deletions']:
-            #     deserialized.deletions.append(self.object_hook(cs_record_ser))
-
-        elif obj['type'] == "ChangesetRecord":
-            deserialized = ChangesetRecord(
-                obj['filename'], obj['mtime'], obj['neighbors'], obj['filesize'])
+        decode = _JSON_DECODERS.get(obj.get('type'))
+        if decode is None:
+            return obj
+        return decode(obj)
+
+
+def _decode_fingerprint(obj: dict) -> Fingerprint:
+    if 'dtype' in obj:
+        # Compact form: base64 encoded raw bytes
+        deserialized = Fingerprint(np.frombuffer(
+            bytearray(b64decode(obj['array'])), dtype=np.dtype(obj['dtype'])))
+    else:
+        deserialized = Fingerprint(np.array(obj['array']))
+    deserialized.method = FingerprintingMethod(obj['method'])
+    deserialized.labels = obj['labels']
+    deserialized.predicted_quantity = obj['predicted_quantity']
+    return deserialized
+
+
+def _decode_changeset(obj: dict) -> Changeset:
+    deserialized = Changeset(obj['open_time'])
+    deserialized.open = obj['open']
+    deserialized.close_time = obj['close_time']
+    deserialized.labels = obj['labels']
+    deserialized.predicted_quantity = obj['predicted_quantity']
+    deserialized.creations = _decode_records(obj['creations'])
+    deserialized.modifications = _decode_records(obj['modifications'])
+    deserialized.deletions = _decode_records(obj['deletions'])
+    return deserialized
+
+
+def _decode_records(records: list) -> list:
+    """
+    Builds a list of ChangesetRecords from their list form, their dict form, or
+    (as left by DSDecoder's object hook) records that were already built
+    """
+    if records and isinstance(records[0], list):
+        return [ChangesetRecord(*record) for record in records]
+    return [record if isinstance(record, ChangesetRecord) else _decode_record(record)
+            for record in records]
 
-        else:
-            # Give up
-            raise ValueError("Unable to determine type of JSON object")
 
-        return deserialized
+def _decode_record(obj: dict) -> ChangesetRecord:
+    return ChangesetRecord(obj['filename'], obj['mtime'], obj['neighbors'], obj['filesize'])
+
+
+# Builders for each type of serialized object, by the value of its 'type' key
+_JSON_DECODERS = {"Fingerprint": _decode_fingerprint,
+                  "Changeset": _decode_changeset,
+                  "ChangesetRecord": _decode_record}
+
 
+# Openers for each supported compression format, by file extension
+_COMPRESSED_EXTENSIONS = {'.gz': gzip.open,
+                          '.bz2': bz2.open,
+                          '.xz': lzma.open,
+                          '.lzma': partial(lzma.open, format=lzma.FORMAT_ALONE)}
+# Openers for each supported compression format, by magic bytes
+_COMPRESSED_MAGIC = [(b"\x1f\x8b", gzip.open),
+                     (b"BZh", bz2.open),
+                     (b"\xfd7zXZ\x00", lzma.open),
+                     (b"\x5d\x00\x00", lzma.open)]
 
-def save_object_as_json(obj: object, save_path: str):
+
+def open_file(path: str, mode: str = 'r'):
+    """
+    Opens a file like the built-in open(), but transparently compresses or
+    decompresses it. When writing, the compression format is chosen by the
+    file extension (.gz, .bz2, .xz, or .lzma). When reading, it is detected
+    from the file's magic bytes. Data is streamed through the (de)compressor,
+    so the compressed and decompressed forms are never both held in memory
+
+    :param path: the full path to the file
+    :param mode: any of 'r', 'w', 'a', 'rb', 'wb', or 'ab'
+    :returns: a file object
+    """
+    opener = None
+    if 'r' in mode:
+        with open(path, 'rb') as raw_file:
+            magic = raw_file.read(6)
+        for prefix, magic_opener in _COMPRESSED_MAGIC:
+            if magic.startswith(prefix):
+                opener = magic_opener
+                break
+    else:
+        opener = _COMPRESSED_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+    if opener is None:
+        return open(path, mode)
+    # Compressed files default to binary mode, so text must be explicit
+    return opener(path, mode if 'b' in mode else mode + 't')
+
+
+def save_object_as_json(obj: object, save_path: str, compact: bool = False):
     """
     Basically saves a text representation of select DeltaSherlock objects to a file.
     Although less space efficient than a regular binary Pickle file, it allows for
@@ -147,20 +239,494 @@ def save_object_as_json(obj: object, save_path: str):
 
     :param obj: the object to be saved (supports anything supported by DSEncoder)
     :param save_path: the full path of the file to be saved (existing files will
-    be overwritten)
+    be overwritten). Compressed if it ends in .gz, .bz2, .xz, or .lzma
+    :param compact: if True, use DSEncoder's compact array and record forms,
+    which older versions of DeltaSherlock cannot read
     """
-    with open(save_path, 'w') as output_file:
-        print(DSEncoder().encode(obj), file=output_file)
+    with open_file(save_path, 'w') as output_file:
+        for chunk in DSEncoder(compact_arrays=compact, compact_records=compact).iterencode(obj):
+            output_file.write(chunk)
+        output_file.write('\n')
 
 
 def load_object_from_json(load_path: str) -> object:
     """
-    Load a file created by save_object_as_json()
+    Load a file created by save_object_as_json(). Compressed files are
+    detected automatically
+
+    :param load_path: the full path to the file
+    """
+    with open_file(load_path, 'r') as input_file:
+        return DSDecoder().decode(input_file.read())
+
+
+def save_objects_as_jsonl(objs, save_path: str, append: bool = True, compact: bool = False) -> int:
+    """
+    Saves any number of select DeltaSherlock objects to a JSON Lines file (one
+    JSON object per line), writing each as soon as it is encoded. Use
+    load_objects_from_jsonl() to read them back one at a time
+
+    :param objs: an iterable of objects (supports anything supported by DSEncoder)
+    :param save_path: the full path of the file to be saved
+    :param append: if True, add to the end of an existing file instead of
+    overwriting it
+    :param compact: if True, use DSEncoder's compact array and record forms
+    (see save_object_as_json())
+    :returns: the number of objects written
+    """
+    encoder = DSEncoder(compact_arrays=compact, compact_records=compact)
+    count = 0
+    with open_file(save_path, 'a' if append else 'w') as output_file:
+        for obj in objs:
+            output_file.write(encoder.encode(obj))
+            output_file.write('\n')
+            count += 1
+    return count
+
+
+def load_objects_from_jsonl(load_path: str):
+    """
+    Lazily load the objects in a file created by save_objects_as_jsonl(). Only
+    one line is held in memory at a time, regardless of the size of the file
+
+    :param load_path: the full path to the file
+    :returns: a generator yielding each object in order
+    """
+    decoder = DSDecoder()
+    with open_file(load_path, 'r') as input_file:
+        for line in input_file:
+            if line.strip():
+                yield decoder.decode(line)
+
+
+def index_jsonl(load_path: str, save_index: bool = False) -> np.ndarray:
+    """
+    Builds a byte-offset index of a JSON Lines file, for random access with
+    load_object_from_jsonl(). The index holds the (decompressed) offset of each
+    object, followed by the size of the file on disk at the time it was indexed
+
+    :param load_path: the full path to the file
+    :param save_index: if True, also save the index alongside the file (as
+    load_path + ".idx") so that it can be reused later
+    :returns: the index, as a NumPy array
+    """
+    offsets = []
+    position = 0
+    with open_file(load_path, 'rb') as input_file:
+        for line in input_file:
+            if line.strip():
+                offsets.append(position)
+            position += len(line)
+    offsets.append(os.path.getsize(load_path))
+    index = np.array(offsets, dtype=np.uint64)
+
+    if save_index:
+        with open(load_path + ".idx", 'wb') as index_file:
+            np.save(index_file, index)
+    return index
+
+
+def load_object_from_jsonl(load_path: str, n: int, index: np.ndarray = None) -> object:
+    """
+    Load only the Nth object (counting from 0) of a JSON Lines file
+
+    :param load_path: the full path to the file. Works with compressed files,
+    but seeking within them requires decompressing everything before the object
+    :param n: the position of the object within the file
+    :param index: an index created by index_jsonl(). If not provided, an index
+    saved alongside the file is used, as long as the file hasn't changed size
+    since. Otherwise, the file is re-indexed
+    """
+    if index is None:
+        try:
+            index = np.load(load_path + ".idx")
+            if int(index[-1]) != os.path.getsize(load_path):
+                index = None
+        except (IOError, ValueError):
+            index = None
+        if index is None:
+            index = index_jsonl(load_path)
+
+    if n < 0 or n >= len(index) - 1:
+        raise IndexError("Object " + str(n) + " not found in " + load_path)
+    with open_file(load_path, 'rb') as input_file:
+        input_file.seek(int(index[n]))
+        return DSDecoder().decode(input_file.readline().decode('utf-8'))
+
+
+# Binary format constants. See object_to_binary() for the layout
+BINARY_MAGIC = b"DSBN"
+BINARY_VERSION = 1
+# Quantized Fingerprints are written as version 2, so that older readers
+# reject them instead of misreading their codes. Everything else stays version 1
+_QUANTIZED_BINARY_VERSION = 2
+_BINARY_TYPES = {1: "Changeset", 2: "Fingerprint"}
+# Dtypes that packed arrays may be stored as, indexed by their type code
+_PACKED_DTYPES = ('<u1', '<u2', '<u4', '<u8', '<i1', '<i2', '<i4', '<i8', '<f8')
+# mtime column encodings
+_MTIME_INT_DELTA = 0
+_MTIME_FLOAT_XOR = 1
+_MTIME_MIXED = 2
+
+
+def object_to_binary(obj: object, quantize: str = None) -> bytes:
+    """
+    Converts a Changeset or Fingerprint to a compact, versioned binary
+    representation. Unlike a Pickle, decoding it never executes code, so it is
+    safe for network transport.
+
+    All integers are little-endian. Every file begins with the 4-byte magic
+    "DSBN", a format version byte, a type byte, and a length-prefixed UTF-8 JSON
+    header of the object's scalar attributes. Changesets follow this with a
+    string table of every filename and neighbor (each stored once), and then
+    one section per record list containing: string table indices of the
+    filenames, delta-encoded mtimes, filesizes, neighbor counts, and neighbor
+    string table indices. Each of these columns is packed into the narrowest
+    integer type that fits. Fingerprints follow the header with their raw array,
+    or with their int8/float16 codes if quantized (the scale is kept in the
+    header)
+
+    :param obj: the Changeset or Fingerprint to be converted
+    :param quantize: 'int8' or 'float16' to store a Fingerprint's array
+    lossily, 4-8x smaller (see quantization.QuantizedMatrix for the error
+    bound). None stores it exactly
+    :returns: the binary representation
+    """
+    if quantize is not None and not isinstance(obj, Fingerprint):
+        raise ValueError("Only Fingerprints can be quantized")
+
+    chunks = []
+    if isinstance(obj, Fingerprint):
+        array = np.ascontiguousarray(obj)
+        header = {'method': obj.method.value,
+                  'labels': obj.labels,
+                  'predicted_quantity': obj.predicted_quantity,
+                  'dtype': array.dtype.newbyteorder('<').str,
+                  'shape': list(array.shape)}
+        if quantize is None:
+            chunks.append(_binary_preamble(2, header))
+            chunks.append(array.astype(header['dtype'], copy=False).tobytes())
+        else:
+            quantized = QuantizedMatrix.quantize(array.reshape(1, -1), quantize)
+            header['quantized'] = quantize
+            header['scale'] = float(quantized.scales[0])
+            chunks.append(_binary_preamble(2, header, _QUANTIZED_BINARY_VERSION))
+            chunks.append(quantized.codes.astype(quantized.dtype.newbyteorder('<'),
+                                                  copy=False).tobytes())
+
+    elif isinstance(obj, Changeset):
+        header = {'open_time': obj.open_time,
+                  'open': obj.open,
+                  'close_time': obj.close_time,
+                  'labels': obj.labels,
+                  'predicted_quantity': obj.predicted_quantity}
+        chunks.append(_binary_preamble(1, header))
+
+        # Build the string table
+        string_index = {}
+        record_lists = (obj.creations, obj.modifications, obj.deletions)
+        for records in record_lists:
+            for record in records:
+                string_index.setdefault(record.filename, len(string_index))
+                for neighbor in record.neighbors:
+                    string_index.setdefault(neighbor, len(string_index))
+        table = "\0".join(string_index).encode('utf-8')
+        chunks.append(np.array([len(string_index), len(table)], dtype='<u8').tobytes())
+        chunks.append(table)
+
+        for records in record_lists:
+            chunks.append(np.array([len(records)], dtype='<u8').tobytes())
+            chunks.append(_pack_array([string_index[r.filename] for r in records]))
+            chunks.append(_pack_mtimes([r.mtime for r in records]))
+            # Filesizes are shifted up by one, so that 0 can represent None
+            chunks.append(_pack_array([0 if r.filesize is None else r.filesize + 1
+                                       for r in records]))
+            chunks.append(_pack_array([len(r.neighbors) for r in records]))
+            chunks.append(_pack_array([string_index[n] for r in records
+                                       for n in r.neighbors]))
+
+    else:
+        raise ValueError("Unable to convert object of type " + type(obj).__name__ + " to binary")
+
+    return b"".join(chunks)
+
+
+def binary_to_object(data: bytes) -> object:
+    """
+    Converts the result of object_to_binary() back to an object
+
+    :param data: the binary representation
+    :returns: the corresponding Changeset or Fingerprint
+    """
+    reader = _BinaryReader(data)
+    if reader.read_bytes(4) != BINARY_MAGIC:
+        raise ValueError("Not a DeltaSherlock binary object")
+    version, type_code = reader.read_bytes(2)
+    if version not in (BINARY_VERSION, _QUANTIZED_BINARY_VERSION):
+        raise ValueError("Unsupported binary format version " + str(version))
+    header = json.loads(reader.read_bytes(int(reader.read_array('<u4', 1)[0])).decode('utf-8'))
+
+    if _BINARY_TYPES.get(type_code) == "Fingerprint":
+        dtype = np.dtype(header['dtype'])
+        count = int(np.prod(header['shape']))
+        if 'quantized' in header:
+            codes = reader.read_array(np.dtype(header['quantized']).newbyteorder('<'), count)
+            quantized = QuantizedMatrix(codes.reshape(1, -1).astype(header['quantized']),
+                                        np.array([header['scale']], dtype=np.float32))
+            array = quantized.dequantize(dtype)
+        else:
+            array = np.frombuffer(reader.read_bytes(count * dtype.itemsize), dtype=dtype)
+        deserialized = Fingerprint(array.reshape(header['shape']).copy())
+        deserialized.method = FingerprintingMethod(header['method'])
+        deserialized.labels = header['labels']
+        deserialized.predicted_quantity = header['predicted_quantity']
+
+    elif _BINARY_TYPES.get(type_code) == "Changeset":
+        deserialized = Changeset(header['open_time'])
+        deserialized.open = header['open']
+        deserialized.close_time = header['close_time']
+        deserialized.labels = header['labels']
+        deserialized.predicted_quantity = header['predicted_quantity']
+
+        num_strings, table_length = reader.read_array('<u8', 2).tolist()
+        strings = reader.read_bytes(table_length).decode('utf-8').split("\0")
+        if num_strings == 0:
+            strings = []
+
+        record_lists = []
+        for _ in range(3):
+            count = int(reader.read_array('<u8', 1)[0])
+            filenames = reader.read_packed(count).tolist()
+            mtimes = _unpack_mtimes(reader, count)
+            filesizes = reader.read_packed(count).tolist()
+            neighbor_counts = reader.read_packed(count)
+            neighbor_indices = reader.read_packed(int(neighbor_counts.sum())).tolist()
+            neighbor_ends = np.cumsum(neighbor_counts).tolist()
+
+            records = []
+            start = 0
+            for i in range(count):
+                end = neighbor_ends[i]
+                records.append(ChangesetRecord(strings[filenames[i]], mtimes[i],
+                                               [strings[j] for j in neighbor_indices[start:end]],
+                                               None if filesizes[i] == 0 else filesizes[i] - 1))
+                start = end
+            record_lists.append(records)
+        deserialized.creations, deserialized.modifications, deserialized.deletions = record_lists
+
+    else:
+        raise ValueError("Unable to determine type of binary object")
+
+    return deserialized
+
+
+def save_object_as_binary(obj: object, save_path: str, quantize: str = None):
+    """
+    Saves the compact binary representation of a Changeset or Fingerprint to a
+    file. Much smaller and faster than save_object_as_json(), and equally safe
+    to load from untrusted sources (see object_to_binary())
+
+    :param obj: the object to be saved
+    :param save_path: the full path of the file to be saved (existing files will
+    be overwritten)
+    :param quantize: 'int8' or 'float16' to store a Fingerprint lossily (see
+    object_to_binary())
+    """
+    with open_file(save_path, 'wb') as output_file:
+        output_file.write(object_to_binary(obj, quantize))
+
+
+def load_object_from_binary(load_path: str) -> object:
+    """
+    Load a file created by save_object_as_binary()
 
     :param load_path: the full path to the file
     """
-    with open(load_path, 'r') as input_file:
-        return DSDecoder().decode(input_file.read().replace('\n', ''))
+    with open_file(load_path, 'rb') as input_file:
+        return binary_to_object(input_file.read())
+
+
+def load_object(load_path: str) -> object:
+    """
+    Load a file created by either save_object_as_binary() or
+    save_object_as_json(), detecting the format (and any compression)
+    automatically
+
+    :param load_path: the full path to the file
+    """
+    with open_file(load_path, 'rb') as input_file:
+        is_binary = input_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    if is_binary:
+        return load_object_from_binary(load_path)
+    return load_object_from_json(load_path)
+
+
+def load_directory(path: str, pattern: str = "*", workers: int = None, chunk_size: int = 16):
+    """
+    Load every saved object in a directory, decoding files in parallel across
+    a process pool. Files are loaded in sorted order, and results are yielded
+    in that same order as soon as they're ready. Only a bounded number of
+    chunks are in flight at once, so memory use does not grow with the size of
+    the directory unless the caller keeps every result. A file that fails to
+    load does not abort the rest of the load
+
+    :param path: the full path to the directory
+    :param pattern: a glob pattern selecting the files to load (ex. "*.json.gz")
+    :param workers: the number of worker processes (default: one per core). With
+    only one worker, files are loaded in this process instead
+    :param chunk_size: the number of files decoded per task
+    :returns: a generator yielding a (file path, object, error) tuple per file,
+    where object is None and error describes the problem if the file could not
+    be loaded
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    paths = sorted(f for f in glob(os.path.join(glob_escape(path), pattern))
+                   if os.path.isfile(f))
+    chunks = deque(paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size))
+
+    if workers <= 1:
+        # Not worth the cost of shipping every object back from another process
+        for chunk in chunks:
+            for result in _load_files(chunk):
+                yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        while chunks or in_flight:
+            # Keep every worker busy, with one chunk queued up behind it
+            while chunks and len(in_flight) < workers * 2:
+                in_flight.append(executor.submit(_load_files, chunks.popleft()))
+            for result in in_flight.popleft().result():
+                yield result
+
+
+def _load_files(paths: list) -> list:
+    """
+    Process pool task for load_directory(). Loads a chunk of files, recording
+    errors instead of raising them
+    """
+    results = []
+    for load_path in paths:
+        try:
+            results.append((load_path, load_object(load_path), None))
+        except Exception as err:
+            results.append((load_path, None, type(err).__name__ + ": " + str(err)))
+    return results
+
+
+def _binary_preamble(type_code: int, header: dict, version: int = BINARY_VERSION) -> bytes:
+    """
+    Returns the magic, version, type, and length-prefixed JSON header
+    """
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return (BINARY_MAGIC + bytes([version, type_code])
+            + np.array([len(header_bytes)], dtype='<u4').tobytes() + header_bytes)
+
+
+def _pack_array(values, signed: bool = False) -> bytes:
+    """
+    Packs a sequence of integers into the narrowest little-endian integer type
+    that fits them, prefixed by a one-byte type code
+    """
+    array = np.asarray(values, dtype='<i8' if signed else '<u8')
+    candidates = _PACKED_DTYPES[4:8] if signed else _PACKED_DTYPES[0:4]
+    dtype = candidates[-1]
+    if array.size == 0:
+        dtype = candidates[0]
+    else:
+        for candidate in candidates:
+            info = np.iinfo(candidate)
+            if array.min() >= info.min and array.max() <= info.max:
+                dtype = candidate
+                break
+    return bytes([_PACKED_DTYPES.index(dtype)]) + array.astype(dtype).tobytes()
+
+
+def _pack_mtimes(mtimes: list) -> bytes:
+    """
+    Delta-encodes a column of mtimes. Integer mtimes are stored as packed
+    differences between neighbors. Float mtimes are stored as the XOR of each
+    value's bits with its neighbor's, which is lossless and leaves the
+    (usually identical) sign, exponent, and leading mantissa bits zeroed.
+    Columns mixing both are stored like floats, followed by a bitmask of which
+    mtimes were integers (so integers up to 2 ** 53 come back unchanged)
+    """
+    is_int = [isinstance(m, int) and not isinstance(m, bool) for m in mtimes]
+    if all(is_int) and all(abs(m) < 2 ** 62 for m in mtimes):
+        array = np.array(mtimes, dtype='<i8')
+        return bytes([_MTIME_INT_DELTA]) + _pack_array(np.diff(array, prepend=0), signed=True)
+
+    bits = np.array(mtimes, dtype='<f8').view('<u8')
+    xored = bits.copy()
+    xored[1:] ^= bits[:-1]
+    if not any(is_int):
+        return bytes([_MTIME_FLOAT_XOR]) + _pack_array(xored)
+    return (bytes([_MTIME_MIXED]) + _pack_array(xored)
+            + np.packbits(np.array(is_int, dtype=bool)).tobytes())
+
+
+def _unpack_mtimes(reader, count: int) -> list:
+    """
+    Reverses _pack_mtimes()
+    """
+    mode = reader.read_bytes(1)[0]
+    if mode == _MTIME_INT_DELTA:
+        return np.cumsum(reader.read_packed(count).astype('<i8')).tolist()
+    if mode in (_MTIME_FLOAT_XOR, _MTIME_MIXED):
+        bits = np.bitwise_xor.accumulate(reader.read_packed(count).astype('<u8'))
+        mtimes = bits.view('<f8').tolist()
+        if mode == _MTIME_MIXED:
+            is_int = np.unpackbits(np.frombuffer(reader.read_bytes((count + 7) // 8),
+                                                 dtype=np.uint8))[:count]
+            for i in np.flatnonzero(is_int).tolist():
+                mtimes[i] = int(mtimes[i])
+        return mtimes
+    raise ValueError("Unknown mtime encoding " + str(mode))
+
+
+class _BinaryReader(object):
+    """
+    Sequential reader over a binary object representation
+    """
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read_bytes(self, length: int) -> bytes:
+        if self.offset + length > len(self.data):
+            raise ValueError("Truncated binary object")
+        chunk = self.data[self.offset:self.offset + length].tobytes()
+        self.offset += length
+        return chunk
+
+    def read_array(self, dtype: str, count: int) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self.read_bytes(count * dtype.itemsize), dtype=dtype)
+
+    def read_packed(self, count: int) -> np.ndarray:
+        """
+        Reads an array written by _pack_array()
+        """
+        type_code = self.read_bytes(1)[0]
+        if type_code >= len(_PACKED_DTYPES):
+            raise ValueError("Unknown packed array type " + str(type_code))
+        return self.read_array(_PACKED_DTYPES[type_code], count)
+
+
+def object_digest(obj: object) -> str:
+    """
+    Computes a SHA-256 content digest of select DeltaSherlock objects, based on
+    their DSEncoder representation. Useful for detecting when a changeset has
+    changed since it was last processed
+
+    :param obj: the object to be hashed (supports anything supported by DSEncoder)
+    :returns: the hex digest
+    """
+    encoded = DSEncoder(sort_keys=True, separators=(',', ':')).encode(obj)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
 
 
 def uid(size=6, chars=string.ascii_uppercase + string.digits):
@@ -187,6 +753,59 @@ def random_activity(testdirpath):
     time.sleep(1)
     return files_created
 
+def random_changeset(num_records: int = 1000, seed=None, labels: list = None) -> Changeset:
+    """
+    Create a closed Changeset of synthetic file activity, without touching the
+    filesystem. Files are drawn from a set of directories derived from each
+    label, so that changesets sharing a label also share files. The same seed
+    and labels always produce the same changeset. For testing and benchmarking
+
+    :param num_records: the number of creation records (a fifth as many
+    modifications and deletions are added as well)
+    :param seed: the seed for the random number generator
+    :param labels: the labels to apply (defaults to a single random label)
+    """
+    rng = random.Random(seed)
+    if labels is None:
+        labels = ["label" + str(rng.randrange(100))]
+
+    # Each label "installs" into its own handful of directories
+    directories = []
+    for label in labels:
+        label_rng = random.Random(str(label))
+        for _ in range(4):
+            directories.append("/" + label_rng.choice(["usr/lib", "usr/share", "etc", "opt", "var/lib"])
+                               + "/" + str(label) + "/"
+                               + "".join(label_rng.choice(string.ascii_lowercase) for _ in range(4)))
+
+    start_time = 1480000000.0 + rng.random() * 1e6
+    changeset = Changeset(start_time)
+    dir_files = {}
+    for i in range(num_records + 2 * (num_records // 5)):
+        directory = rng.choice(directories)
+        filename = (directory + "/" + "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+                    + rng.choice([".so", ".py", ".conf", ".h", "", ".so." + str(rng.randint(0, 9))]))
+        dir_files.setdefault(directory, []).append(filename)
+        mtime = start_time + i * 0.01 + rng.random() * 0.01
+        if i < num_records:
+            changeset.creations.append(ChangesetRecord(filename, mtime, filesize=rng.randint(0, 1 << 20)))
+        elif i < num_records + num_records // 5:
+            changeset.modifications.append(ChangesetRecord(filename, mtime, filesize=rng.randint(0, 1 << 20)))
+        else:
+            changeset.deletions.append(ChangesetRecord(filename, mtime))
+
+    changeset.close(start_time + (num_records * 1.4) * 0.01 + 1)
+
+    # close() could not find neighbors for these made-up files, so fill them in
+    for record in changeset.creations + changeset.modifications + changeset.deletions:
+        siblings = dir_files[os.path.dirname(record.filename)]
+        record.neighbors = [os.path.basename(f) for f in siblings[:20]
+                            if f != record.filename]
+
+    for label in labels:
+        changeset.add_label(label)
+    return changeset
+
 ###### BEGIN DEPRECATED CODE #######
 # The following code was deprecated on Jan. 5, 2017 in order to reduce the
 # use of Python pickles throughout DeltaSherlock. Pickles from unknown sources
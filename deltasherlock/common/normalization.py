@@ -0,0 +1,148 @@
+# DeltaSherlock. See README.md for usage. See LICENSE for MIT/X11 license info.
+"""
+DeltaSherlock token normalization module. Contains normalizers that collapse
+randomized or versioned filename tokens (ie. "tmpk3j9x2ABC123" or
+"libfoo.so.1.2.3") into stable forms before they reach a w2v dictionary
+"""
+import re
+import json
+import hashlib
+
+# Name of the attribute used to record a normalizer on a w2v dictionary
+DICTIONARY_ATTRIBUTE = "ds_normalizer"
+
+# Default rules used by the PatternNormalizer. Each rule is a tuple of a regex
+# and its replacement, applied in order. Replacements must never be matched
+# again by any rule, so that normalizing a token twice yields the same result
+DEFAULT_RULES = [
+    # Versioned shared objects: libfoo.so.1.2.3 -> libfoo.so
+    (r"(\.so)(\.\d+)+$", r"\1"),
+    # Hash-named files: whole runs of at least 12 hex digits, with at least one
+    # digit and one letter
+    (r"(?i)(?<![0-9a-z])(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{12,}(?![0-9a-z])", "#"),
+    # Random suffixes (ie. from mkstemp): long alphanumeric runs that switch
+    # from letters to digits at least three times. Real names rarely switch
+    # more than once or twice (ie. "sha256sum" or "ubuntu16")
+    (r"(?<![A-Za-z0-9_])(?=(?:[A-Za-z0-9_]*?[A-Za-z]+\d+){3})[A-Za-z0-9_]{8,}", "#"),
+    # Remaining version strings, keeping the major version: 2.7.13 -> 2
+    (r"(\d+)(\.\d+)+", r"\1"),
+    # Remaining long digit runs (timestamps, PIDs, etc.)
+    (r"\d{4,}", "0"),
+]
+
+
+class TokenNormalizer(object):
+    """
+    The default (identity) normalizer. Leaves all tokens untouched. Subclasses
+    should override normalize() and provide a unique name so that dictionaries
+    can record which normalizer they were built with
+
+    :attribute name: the unique name used to register and look up this normalizer
+    """
+    name = "identity"
+
+    def normalize(self, token: str) -> str:
+        """
+        Normalize a single token (ie. a path component or basename)
+
+        :param token: the token to be normalized
+        :returns: the normalized token
+        """
+        return token
+
+    def normalize_sentence(self, sentence: list) -> list:
+        """
+        Normalize every word in a sentence
+
+        :param sentence: a list of words
+        :returns: the list of normalized words
+        """
+        return [self.normalize(word) for word in sentence]
+
+    def __call__(self, token: str) -> str:
+        return self.normalize(token)
+
+    def __eq__(self, other):
+        # Equal normalizers produce identical tokens
+        return (type(self) is type(other) and self.name == other.name
+                and self.__dict__ == other.__dict__)
+
+    def __hash__(self):
+        return hash((type(self), self.name))
+
+    def __repr__(self):
+        return "<" + self.name + " token normalizer>"
+
+
+class PatternNormalizer(TokenNormalizer):
+    """
+    Normalizes tokens by applying a list of regex substitution rules in order.
+    By default, collapses hex/digit runs, random suffixes, and version suffixes.
+    Custom rules get a name derived from the rules themselves (unless one is
+    given), and must be registered (see register_normalizer()) before they can
+    be used to build a dictionary
+
+    :attribute rules: the list of compiled regexes and their replacements
+    """
+    name = "pattern"
+
+    def __init__(self, rules: list = None, name: str = None):
+        if rules is None:
+            rules = DEFAULT_RULES
+        elif name is None and rules != DEFAULT_RULES:
+            digest = hashlib.sha256(json.dumps([list(rule) for rule in rules]).encode('utf-8'))
+            name = "pattern-" + digest.hexdigest()[:12]
+        if name is not None:
+            self.name = name
+        self.rules = [(re.compile(pattern), replacement)
+                      for pattern, replacement in rules]
+
+    def normalize(self, token: str) -> str:
+        for pattern, replacement in self.rules:
+            token = pattern.sub(replacement, token)
+        return token
+
+
+# All normalizers that a dictionary can refer to by name
+NORMALIZERS = {}
+
+
+def register_normalizer(normalizer: TokenNormalizer):
+    """
+    Make a normalizer available for lookup by name. Needed for any custom
+    normalizer used to build a dictionary, so that the same normalizer can be
+    found again when fingerprinting against that dictionary
+
+    :param normalizer: the TokenNormalizer instance to be registered
+    """
+    NORMALIZERS[normalizer.name] = normalizer
+
+
+def get_normalizer(name: str = None) -> TokenNormalizer:
+    """
+    Look up a registered normalizer by name
+
+    :param name: the name of the normalizer, or None for the identity normalizer
+    :returns: the corresponding TokenNormalizer
+    """
+    if name is None:
+        name = TokenNormalizer.name
+    try:
+        return NORMALIZERS[name]
+    except KeyError:
+        raise ValueError("Unknown token normalizer: " + str(name))
+
+
+def dictionary_normalizer(dictionary) -> TokenNormalizer:
+    """
+    Returns the normalizer a w2v dictionary was built with. Dictionaries created
+    before normalizers existed are treated as identity-normalized
+
+    :param dictionary: a gensim Word2Vec object created by create_dictionary()
+    :returns: the corresponding TokenNormalizer
+    """
+    return get_normalizer(getattr(dictionary, DICTIONARY_ATTRIBUTE, None))
+
+
+register_normalizer(TokenNormalizer())
+register_normalizer(PatternNormalizer())
@@ -0,0 +1,138 @@
+# DeltaSherlock. See README.md for usage. See LICENSE for MIT/X11 license info.
+"""
+DeltaSherlock quantization module. Contains a codec for storing fingerprint
+vectors as scaled int8 or float16 values, shrinking fingerprint archives 4-8x
+with a known, bounded error
+"""
+import numpy as np
+
+# Supported code dtypes, and the largest code magnitude each one uses
+QUANTIZED_DTYPES = {'int8': 127, 'float16': 1}
+
+# The worst-case absolute error of each dtype, as a multiple of a row's scale.
+# Both include slack for rounding when the result is stored as float32
+_ERROR_FACTORS = {'int8': 0.5 + 2 ** -16, 'float16': 2 ** -11 + 2 ** -16}
+
+# Rows are processed this many at a time, to bound temporary memory
+_BLOCK_SIZE = 65536
+
+
+class QuantizedMatrix(object):
+    """
+    A 2-D array of vectors, each stored as int8 or float16 codes and a float32
+    scale. A vector is recovered as codes * scale. Every value of a dequantized
+    vector is within error_bound() of the original (after NaNs and infinities
+    are replaced, as np.nan_to_num() would)
+
+    :attribute codes: the (rows, columns) array of int8 or float16 codes
+    :attribute scales: the (rows,) float32 array of scales
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        if codes.dtype.name not in QUANTIZED_DTYPES:
+            raise ValueError("Unsupported quantized dtype " + codes.dtype.name)
+        if codes.ndim != 2 or scales.shape != (codes.shape[0],):
+            raise ValueError("Expected a 2-D array of codes and one scale per row")
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, matrix, dtype: str = 'int8'):
+        """
+        Quantize a matrix (or a list of Fingerprints) one row at a time
+
+        :param matrix: a 2-D array, or a list of equal-length vectors
+        :param dtype: 'int8' (4-8x smaller, error up to half a step of
+        max(abs(row)) / 127) or 'float16' (2-4x smaller, error up to about
+        max(abs(row)) / 2048)
+        :returns: the QuantizedMatrix
+        """
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError("Unsupported quantized dtype " + str(dtype))
+        if not isinstance(matrix, np.ndarray):
+            matrix = np.array(matrix)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        max_code = QUANTIZED_DTYPES[dtype]
+
+        codes = np.empty(matrix.shape, dtype=dtype)
+        scales = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], _BLOCK_SIZE):
+            block = np.nan_to_num(np.asarray(matrix[start:start + _BLOCK_SIZE],
+                                             dtype=np.float64))
+            block_scales = (np.abs(block).max(axis=1, initial=0) / max_code).astype(np.float32)
+            scales[start:start + _BLOCK_SIZE] = block_scales
+            # All-zero rows keep a scale of zero and all-zero codes
+            divisors = np.where(block_scales == 0, 1, block_scales).astype(np.float64)
+            block /= divisors[:, np.newaxis]
+            if dtype == 'int8':
+                np.rint(block, out=block)
+                np.clip(block, -max_code, max_code, out=block)
+            codes[start:start + _BLOCK_SIZE] = block
+        return cls(codes, scales)
+
+    def dequantize(self, dtype=np.float32, out: np.ndarray = None) -> np.ndarray:
+        """
+        Recover every vector at once
+
+        :param dtype: the dtype of the result
+        :param out: an optional array to write the result into
+        :returns: the (rows, columns) array
+        """
+        if out is None:
+            out = np.empty(self.codes.shape, dtype=dtype)
+        for start in range(0, self.codes.shape[0], _BLOCK_SIZE):
+            stop = start + _BLOCK_SIZE
+            np.multiply(self.codes[start:stop], self.scales[start:stop, np.newaxis],
+                        out=out[start:stop], casting='unsafe')
+        return out
+
+    def error_bound(self) -> np.ndarray:
+        """
+        Returns the largest possible absolute error of each row's values
+        """
+        return self.scales.astype(np.float64) * _ERROR_FACTORS[self.codes.dtype.name]
+
+    def save(self, save_path: str):
+        """
+        Save to an (uncompressed) .npz file
+
+        :param save_path: the full path of the file to be saved
+        """
+        with open(save_path, 'wb') as output_file:
+            np.savez(output_file, codes=self.codes, scales=self.scales)
+
+    @classmethod
+    def load(cls, load_path: str):
+        """
+        Load a file created by save()
+
+        :param load_path: the full path to the file
+        :returns: the QuantizedMatrix
+        """
+        with np.load(load_path, allow_pickle=False) as archive:
+            return cls(archive['codes'], archive['scales'])
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.codes.dtype
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1 if rows != -1 else None)
+        return QuantizedMatrix(self.codes[rows], self.scales[rows])
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __repr__(self):
+        return ("<" + str(self.shape[0]) + "x" + str(self.shape[1]) + " "
+                + self.dtype.name + " quantized matrix>")
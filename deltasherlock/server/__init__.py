@@ -1,3 +1,6 @@
 from . import learning
+from . import queueing
+from . import serving
+from . import tuning
 from . import worker
 from . import manager
@@ -4,14 +4,24 @@
 DeltaSherlock server training module. Contains code for creating trained machine
 learning models from training fingerprints
 """
+import os
+import pickle
+import shutil
+import tempfile
+from collections import Counter
 from enum import Enum, unique
 import numpy as np
+from scipy import sparse
+from scipy.special import expit
 from sklearn import svm, tree, preprocessing
+from sklearn.base import BaseEstimator, clone, is_classifier
 from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier, \
     GradientBoostingClassifier
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.multiclass import OneVsRestClassifier
 from deltasherlock.common.fingerprinting import Fingerprint
+from deltasherlock.common.quantization import QuantizedMatrix, QUANTIZED_DTYPES
+from deltasherlock.server.serving import prediction_inputs, top_classes
 
 
 @unique
@@ -28,6 +38,408 @@ class MLAlgorithm(Enum):
     svm_linear = 5
     adaboost = 6
     gradient_boosting = 7
+    nearest_neighbor = 8
+    sgd_logistic_regression = 9
+
+
+class NearestNeighborClassifier(object):
+    """
+    A multi-label k-nearest-neighbor classifier with the parts of the sklearn
+    API that MLModel relies on. Stored fingerprints are kept as a matrix of
+    L2-normalized float32 rows, so cosine similarity is a matrix product. The
+    products are computed in blocks, so memory use stays bounded no matter how
+    many fingerprints are stored. Unlike the other algorithms, fingerprints can
+    be added without retraining. Rows can also be stored quantized, which cuts
+    memory 4x (int8) or 2x (float16) at the cost of a small error in each
+    similarity (see quantization.QuantizedMatrix)
+
+    :attribute n_neighbors: the number of neighbors that vote on each prediction
+    :attribute block_size: the number of stored fingerprints compared per block
+    :attribute quantize: None, 'int8', or 'float16'. Takes effect on fit()
+    """
+
+    def __init__(self, n_neighbors: int = 5, block_size: int = 16384, quantize: str = None):
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.quantize = quantize
+        self.__matrix = np.zeros((0, 0), dtype=np.float32)
+        # The scale of each stored row, if quantized
+        self.__scales = np.zeros(0, dtype=np.float32)
+        self.__size = 0
+        # One row per stored fingerprint, one column per class
+        self.__labels = sparse.csr_matrix((0, 0), dtype=np.float32)
+        # Label rows added since __labels was last stacked
+        self.__pending_labels = []
+
+    @property
+    def classes_(self):
+        return np.arange(self.__labels.shape[1])
+
+    @property
+    def n_features_in_(self):
+        return self.__matrix.shape[1]
+
+    def fit(self, X, Y):
+        """
+        Replace all stored fingerprints
+
+        :param X: a 2-D array with one fingerprint per row
+        :param Y: a binary matrix with one row per fingerprint and one column
+        per class
+        :returns: self
+        """
+        if self.quantize is not None and self.quantize not in QUANTIZED_DTYPES:
+            raise ValueError("Unsupported quantized dtype " + str(self.quantize))
+        X = np.asarray(X)
+        self.__matrix = np.zeros((0, X.shape[1]), dtype=self.quantize or np.float32)
+        self.__scales = np.zeros(0, dtype=np.float32)
+        self.__size = 0
+        self.__labels = sparse.csr_matrix((0, Y.shape[1]), dtype=np.float32)
+        self.__pending_labels = []
+        return self.add(X, Y)
+
+    def add(self, X, Y):
+        """
+        Store more fingerprints. The underlying matrix grows geometrically, and
+        labels are only stacked onto the label matrix when it is next needed, so
+        adding fingerprints one at a time stays cheap
+
+        :param X: a 2-D array with one fingerprint per row
+        :param Y: a binary matrix with one row per fingerprint and one column
+        per class
+        :returns: self
+        """
+        rows = self.__normalize(X)
+        end = self.__size + rows.shape[0]
+        if end > self.__matrix.shape[0]:
+            capacity = max(end, 2 * self.__matrix.shape[0])
+            grown = np.zeros((capacity, rows.shape[1]), dtype=self.__matrix.dtype)
+            grown[:self.__size] = self.__matrix[:self.__size]
+            self.__matrix = grown
+            grown = np.zeros(capacity, dtype=np.float32)
+            grown[:self.__size] = self.__scales[:self.__size]
+            self.__scales = grown
+        if self.__matrix.dtype.name in QUANTIZED_DTYPES:
+            quantized = QuantizedMatrix.quantize(rows, self.__matrix.dtype.name)
+            rows = quantized.codes
+            self.__scales[self.__size:end] = quantized.scales
+        self.__matrix[self.__size:end] = rows
+        self.__size = end
+        self.__pending_labels.append(sparse.csr_matrix(Y, dtype=np.float32))
+        return self
+
+    def remap_classes(self, mapping, num_classes: int):
+        """
+        Move each stored class to a new column, ie. after new classes have been
+        inserted into the binarizer
+
+        :param mapping: an array containing the new column of each old column
+        :param num_classes: the new number of classes
+        """
+        labels = self.__stacked_labels().tocoo()
+        self.__labels = sparse.csr_matrix(
+            (labels.data, (labels.row, np.asarray(mapping)[labels.col])),
+            shape=(labels.shape[0], num_classes), dtype=np.float32)
+
+    def kneighbors(self, X):
+        """
+        Find the most similar stored fingerprints of each row of X
+
+        :param X: a 2-D array with one fingerprint per row
+        :returns: a tuple of two (rows, k) arrays: the cosine similarities and
+        the indices of the nearest stored fingerprints
+        """
+        queries = self.__normalize(X)
+        k = min(self.n_neighbors, self.__size)
+        best_similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+        best_indices = np.empty((queries.shape[0], k), dtype=np.int64)
+
+        # Keep each block of similarities to about block_size ** 2 / 64 values
+        query_block_size = max(1, self.block_size // 64)
+        for query_start in range(0, queries.shape[0], query_block_size):
+            query_stop = query_start + query_block_size
+            block_similarities, block_indices = self.__kneighbors_block(
+                queries[query_start:query_stop], k)
+            best_similarities[query_start:query_stop] = block_similarities
+            best_indices[query_start:query_stop] = block_indices
+
+        return best_similarities, best_indices
+
+    def __kneighbors_block(self, queries, k: int):
+        best_similarities = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+
+        for start in range(0, self.__size, self.block_size):
+            stop = min(start + self.block_size, self.__size)
+            similarities = queries.dot(self.__stored(start, stop).T)
+            # Keep the best k of the previous best and this block
+            candidates = np.hstack((best_similarities, similarities))
+            top = np.argpartition(candidates, -k, axis=1)[:, -k:]
+            best_similarities = np.take_along_axis(candidates, top, axis=1)
+            # Positions past the previous best are offsets into this block
+            best_indices = np.where(
+                top < k,
+                np.take_along_axis(best_indices, np.minimum(top, k - 1), axis=1),
+                top - k + start)
+
+        return best_similarities, best_indices
+
+    def __stored(self, start: int, stop: int) -> np.ndarray:
+        # Dequantize one block at a time, so only the block is ever float32
+        if self.__matrix.dtype.name in QUANTIZED_DTYPES:
+            return QuantizedMatrix(self.__matrix[start:stop],
+                                   self.__scales[start:stop]).dequantize(np.float32)
+        return self.__matrix[start:stop]
+
+    def predict_proba(self, X):
+        """
+        Score each class by the similarity-weighted share of the nearest
+        neighbors carrying it
+
+        :param X: a 2-D array with one fingerprint per row
+        :returns: a (rows, classes) array of scores between 0 and 1
+        """
+        similarities, indices = self.kneighbors(X)
+        # Dissimilar neighbors get no vote, unless none are similar at all
+        weights = np.clip(similarities, 0, None)
+        unweighted = weights.sum(axis=1) == 0
+        weights[unweighted] = 1
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        votes = sparse.csr_matrix(
+            (weights.ravel(), indices.ravel(),
+             np.arange(0, weights.size + 1, weights.shape[1])),
+            shape=(weights.shape[0], self.__size))
+        return votes.dot(self.__stacked_labels()).toarray()
+
+    def predict(self, X):
+        """
+        Predict every class held by the (weighted) majority of the neighbors
+
+        :param X: a 2-D array with one fingerprint per row
+        :returns: a (rows, classes) binary array
+        """
+        return (self.predict_proba(X) > 0.5).astype(np.int64)
+
+    def __normalize(self, X):
+        rows = np.nan_to_num(np.asarray(X, dtype=np.float32))
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return rows / norms
+
+    def __stacked_labels(self):
+        if self.__pending_labels:
+            self.__labels = sparse.vstack([self.__labels] + self.__pending_labels,
+                                          format='csr')
+            self.__pending_labels = []
+        return self.__labels
+
+    def __len__(self):
+        return self.__size
+
+    def __getstate__(self):
+        # Don't pickle the unused capacity
+        self.__stacked_labels()
+        state = self.__dict__.copy()
+        state['_NearestNeighborClassifier__matrix'] = self.__matrix[:self.__size]
+        state['_NearestNeighborClassifier__scales'] = self.__scales[:self.__size]
+        return state
+
+    def __setstate__(self, state):
+        # Classifiers pickled before quantization was supported
+        state.setdefault('quantize', None)
+        state.setdefault('_NearestNeighborClassifier__scales',
+                         np.zeros(0, dtype=np.float32))
+        state.setdefault('_NearestNeighborClassifier__pending_labels', [])
+        self.__dict__.update(state)
+
+
+class OnlineClassifier(object):
+    """
+    A multi-label classifier made of one SGD logistic regression per class,
+    with the parts of the sklearn API that MLModel relies on. Unlike
+    OneVsRestClassifier, it can keep learning from new fingerprints (including
+    ones with never-before-seen classes) via partial_fit(). A bounded random
+    sample of past fingerprints is replayed alongside each new batch, so an
+    update made up of a single (ie. new) class doesn't teach the estimators
+    that every fingerprint carries it
+
+    :attribute epochs: the number of passes made over each batch of fingerprints
+    :attribute alpha: the regularization strength of each SGDClassifier
+    :attribute memory_size: the number of past fingerprints kept for replay
+    """
+
+    def __init__(self, epochs: int = 5, alpha: float = 0.0001, memory_size: int = 1000):
+        self.epochs = epochs
+        self.alpha = alpha
+        self.memory_size = memory_size
+        self.estimators_ = []
+        self.__reset_memory()
+
+    @property
+    def classes_(self):
+        return np.arange(len(self.estimators_))
+
+    @property
+    def n_features_in_(self):
+        return self.estimators_[0].n_features_in_
+
+    def fit(self, X, Y):
+        """
+        Train a fresh estimator for every class
+
+        :param X: a 2-D array with one fingerprint per row
+        :param Y: a binary matrix with one row per fingerprint and one column
+        per class
+        :returns: self
+        """
+        self.estimators_ = [None] * Y.shape[1]
+        self.__reset_memory()
+        return self.partial_fit(X, Y)
+
+    def partial_fit(self, X, Y):
+        """
+        Continue training every estimator on a new batch of fingerprints, plus
+        the remembered past ones. Classes without an estimator yet (see
+        remap_classes()) get a new one, which sees the past fingerprints as
+        negative examples
+
+        :param X: a 2-D array with one fingerprint per row
+        :param Y: a binary matrix with one row per fingerprint and one column
+        per class
+        :returns: self
+        """
+        if Y.shape[1] != len(self.estimators_):
+            raise ValueError("Expected one column per class")
+        X = np.asarray(X)
+        Y = sparse.csc_matrix(Y)
+        train_X, train_Y = X, Y
+        if len(self.__memory_labels):
+            # SGD is sensitive to order, so the batch and the remembered
+            # fingerprints are shuffled together
+            order = self.__random.permutation(X.shape[0] + len(self.__memory_labels))
+            train_X = np.vstack((X, self.__memory_X))[order]
+            train_Y = sparse.vstack((Y, self.__memory_matrix()), format='csr')[order].tocsc()
+
+        for index, estimator in enumerate(self.estimators_):
+            if estimator is None:
+                estimator = SGDClassifier(loss='log_loss', alpha=self.alpha,
+                                          random_state=index)
+                self.estimators_[index] = estimator
+            y = train_Y[:, index].toarray().ravel()
+            for _ in range(self.epochs):
+                estimator.partial_fit(train_X, y, classes=[0, 1])
+
+        self.__remember(X, Y)
+        return self
+
+    def remap_classes(self, mapping, num_classes: int):
+        """
+        Move each estimator to a new class index, ie. after new classes have
+        been inserted into the binarizer. The new classes are left without an
+        estimator until the next partial_fit()
+
+        :param mapping: an array containing the new index of each old class
+        :param num_classes: the new number of classes
+        """
+        estimators = [None] * num_classes
+        for old_index, new_index in enumerate(mapping):
+            estimators[new_index] = self.estimators_[old_index]
+        self.estimators_ = estimators
+        mapping = np.asarray(mapping)
+        self.__memory_labels = [mapping[labels] for labels in self.__memory_labels]
+
+    def __reset_memory(self):
+        self.__memory_X = None
+        # The class indices of each remembered fingerprint
+        self.__memory_labels = []
+        self.__seen = 0
+        self.__random = np.random.RandomState(0)
+
+    def __memory_matrix(self):
+        return sparse.csr_matrix(
+            (np.ones(sum(len(labels) for labels in self.__memory_labels)),
+             np.concatenate(self.__memory_labels).astype(np.int64),
+             np.cumsum([0] + [len(labels) for labels in self.__memory_labels])),
+            shape=(len(self.__memory_labels), len(self.estimators_)))
+
+    def __remember(self, X, Y):
+        """
+        Reservoir-sample the rows of a batch into the memory, so that it holds a
+        uniform sample of every fingerprint seen so far
+        """
+        Y = sparse.csr_matrix(Y)
+        labels = [Y.indices[Y.indptr[row]:Y.indptr[row + 1]] for row in range(X.shape[0])]
+        if self.__memory_X is None:
+            self.__memory_X = np.zeros((0, X.shape[1]), dtype=np.float32)
+
+        # Fill any free slots first
+        free = max(0, min(self.memory_size - len(self.__memory_labels), X.shape[0]))
+        self.__memory_X = np.vstack((self.__memory_X, np.asarray(X[:free], dtype=np.float32)))
+        self.__memory_labels += labels[:free]
+
+        # Then the nth fingerprint seen replaces a random slot with
+        # probability memory_size / n
+        seen = self.__seen + free + np.arange(1, X.shape[0] - free + 1)
+        slots = (self.__random.random_sample(seen.size) * seen).astype(np.int64)
+        for row, slot in zip(np.flatnonzero(slots < self.memory_size) + free,
+                             slots[slots < self.memory_size]):
+            self.__memory_X[slot] = X[row]
+            self.__memory_labels[slot] = labels[row]
+        self.__seen += X.shape[0]
+
+    def predict_proba(self, X):
+        """
+        :param X: a 2-D array with one fingerprint per row
+        :returns: a (rows, classes) array of the probability of each class
+        """
+        # All estimators share one matrix product rather than one call each
+        coefs = np.vstack([estimator.coef_ for estimator in self.estimators_])
+        intercepts = np.hstack([estimator.intercept_ for estimator in self.estimators_])
+        return expit(np.asarray(X).dot(coefs.T) + intercepts)
+
+    def predict(self, X):
+        """
+        :param X: a 2-D array with one fingerprint per row
+        :returns: a (rows, classes) binary array
+        """
+        return (self.predict_proba(X) > 0.5).astype(np.int64)
+
+    def __setstate__(self, state):
+        # Classifiers pickled before past fingerprints were remembered
+        self.__dict__.update(state)
+        if '_OnlineClassifier__memory_labels' not in state:
+            self.memory_size = 1000
+            self.__reset_memory()
+
+
+class ConstantPredictor(BaseEstimator):
+    """
+    Stands in for the classifier of a label present in all (or none) of the
+    training fingerprints, which can't be fit. Provides the parts of the API
+    that OneVsRestClassifier uses on its per-label estimators
+
+    :attribute y_: an array holding the constant label (0 or 1)
+    """
+
+    def fit(self, X, y):
+        """
+        :param X: a 2-D array with one fingerprint per row
+        :param y: the (constant) label of each row
+        :returns: self
+        """
+        self.y_ = np.unique(y)[:1]
+        self.n_features_in_ = np.shape(X)[1]
+        return self
+
+    def decision_function(self, X):
+        return np.repeat(self.y_, np.shape(X)[0])
+
+    def predict(self, X):
+        return np.repeat(self.y_, np.shape(X)[0])
+
+    def predict_proba(self, X):
+        return np.repeat([np.hstack([1 - self.y_, self.y_])], np.shape(X)[0], axis=0)
 
 
 class MLModel(object):
@@ -35,87 +447,676 @@ class MLModel(object):
     Container for items needed to machine learn
     """
 
-    def __init__(self, fingerprints: list, algorithm: MLAlgorithm, method=None):
+    def __init__(self, fingerprints: list, algorithm: MLAlgorithm, method=None,
+                 n_jobs: int = None, params: dict = None):
         """
         Initialize and train the model with a list of Fingerprints using the
         specified MLAlgorithm
+
+        :param fingerprints: the list of labeled training Fingerprints
+        :param algorithm: the MLAlgorithm to be used
+        :param method: the FingerprintingMethod of the fingerprints. If None,
+        the method of the first fingerprint is used
+        :param n_jobs: the number of per-label classifiers to train in
+        parallel. None means 1, -1 means one per core. Prediction is not
+        parallelized
+        :param params: optional hyperparameters overriding the algorithm's
+        defaults (see create_estimator())
         """
         if method is None:
-            self.method = fingerprints[0].method
-        else:
-            self.method = method
+            method = fingerprints[0].method
         for fingerprint in fingerprints:
-            if fingerprint.method != self.method:
+            if fingerprint.method != method:
                 raise ValueError("Models can only be trained with one fingerprinting method at a time")
 
-        self.num_fingerprints = len(fingerprints)
-        self.algorithm = algorithm
-        if self.algorithm == MLAlgorithm.logistic_regression:
-            self.model = LogisticRegression(C=10000)
-        elif self.algorithm == MLAlgorithm.decision_tree:
-            self.model = tree.DecisionTreeClassifier()
-        elif self.algorithm == MLAlgorithm.random_forest:
-            self.model = RandomForestClassifier(n_estimators=100)
-        elif self.algorithm == MLAlgorithm.svm_rbf:
-            self.model = svm.SVC(C=500, gamma=1, probability=True)
-        elif self.algorithm == MLAlgorithm.svm_linear:
-            self.model = svm.LinearSVC(C=500)
-        elif self.algorithm == MLAlgorithm.adaboost:
-            self.model = AdaBoostClassifier()
-        elif self.algorithm == MLAlgorithm.gradient_boosting:
-            self.model = GradientBoostingClassifier(learning_rate=0.1, n_estimators=40,
-                                                    max_depth=3)
+        self.__setup(algorithm, method, n_jobs, params)
+        self.__fit(fingerprint_matrix(fingerprints),
+                   [fingerprint.labels for fingerprint in fingerprints])
+
+    @classmethod
+    def from_matrix(cls, matrix, label_lists: list, algorithm: MLAlgorithm,
+                    method, n_jobs: int = None, params: dict = None):
+        """
+        Initialize and train a model from a 2-D array of fingerprints, without
+        needing the Fingerprint objects themselves. The matrix is only copied
+        if it contains NaNs or infinities, so a read-only (ie. memory-mapped)
+        matrix can be shared by several models. A QuantizedMatrix is
+        dequantized to float32 in one pass
+
+        :param matrix: a 2-D array (or QuantizedMatrix) with one training
+        fingerprint per row
+        :param label_lists: a list containing the list of labels of each row
+        :param algorithm: the MLAlgorithm to be used
+        :param method: the FingerprintingMethod of the fingerprints
+        :param n_jobs: see __init__()
+        :param params: see __init__()
+        :returns: the trained MLModel
+        """
+        if len(label_lists) != matrix.shape[0]:
+            raise ValueError("Expected one list of labels per row")
+        if isinstance(matrix, QuantizedMatrix):
+            matrix = matrix.dequantize()
+        elif not np.isfinite(matrix).all():
+            matrix = np.nan_to_num(matrix)
+
+        model = cls.__new__(cls)
+        model.__setup(algorithm, method, n_jobs, params)
+        model.__fit(matrix, label_lists)
+        return model
+
+    @staticmethod
+    def create_estimator(algorithm: MLAlgorithm, params: dict = None):
+        """
+        Create the (untrained) estimator used by the specified MLAlgorithm. For
+        everything but nearest_neighbor and sgd_logistic_regression, this is
+        the binary estimator trained once per label
+
+        :param algorithm: the MLAlgorithm
+        :param params: optional hyperparameters (ie. {"C": 100}) overriding
+        the defaults below
+        :returns: the estimator
+        """
+        estimator = MLModel.__default_estimator(algorithm)
+        for name, value in (params or {}).items():
+            if hasattr(estimator, 'set_params'):
+                estimator.set_params(**{name: value})
+            elif hasattr(estimator, name):
+                setattr(estimator, name, value)
+            else:
+                raise ValueError("Invalid parameter " + name + " for " + algorithm.name)
+        return estimator
+
+    @staticmethod
+    def __default_estimator(algorithm: MLAlgorithm):
+        if algorithm == MLAlgorithm.logistic_regression:
+            return LogisticRegression(C=10000)
+        elif algorithm == MLAlgorithm.decision_tree:
+            return tree.DecisionTreeClassifier()
+        elif algorithm == MLAlgorithm.random_forest:
+            return RandomForestClassifier(n_estimators=100)
+        elif algorithm == MLAlgorithm.svm_rbf:
+            return svm.SVC(C=500, gamma=1, probability=True)
+        elif algorithm == MLAlgorithm.svm_linear:
+            return svm.LinearSVC(C=500)
+        elif algorithm == MLAlgorithm.adaboost:
+            return AdaBoostClassifier()
+        elif algorithm == MLAlgorithm.gradient_boosting:
+            return GradientBoostingClassifier(learning_rate=0.1, n_estimators=40,
+                                              max_depth=3)
+        elif algorithm == MLAlgorithm.nearest_neighbor:
+            return NearestNeighborClassifier()
+        elif algorithm == MLAlgorithm.sgd_logistic_regression:
+            return OnlineClassifier()
         else:
             raise ValueError("Invalid MLAlgorithm specified")
 
-        # Setup ML Resources
-        self.classifier = OneVsRestClassifier(self.model)
-        self.binarizer = preprocessing.MultiLabelBinarizer()
+    @classmethod
+    def train_distributed(cls, fingerprints: list, algorithm: MLAlgorithm,
+                          work_path: str, labels_per_job: int = 10, queue=None,
+                          timeout: int = None, params: dict = None):
+        """
+        Train a model with its per-label classifiers split across RQ jobs. The
+        feature matrix is saved once and memory-mapped by every job, and each
+        job saves its fitted classifiers back to disk, so neither travels
+        through Redis. Everything is kept in a new subdirectory of work_path
+        (so several runs can share it), which is removed once training
+        finishes. The result predicts exactly like a model trained by
+        __init__(). Not available for nearest_neighbor or
+        sgd_logistic_regression models
 
-        # Creates list of labels, in order
-        # __labels is a list of lists of labels (one list per fp)
-        self.__labels = []
-        # labels is just a "flattened" version of above
-        self.labels = []
+        :param fingerprints: the list of labeled training Fingerprints
+        :param algorithm: the MLAlgorithm to be used
+        :param work_path: a directory that every worker can read and write
+        :param labels_per_job: the number of labels trained by each job
+        :param queue: the rq.Queue to use (default: queueing.get_queue())
+        :param timeout: the maximum number of seconds to wait for all jobs
+        :param params: see __init__()
+        :returns: the trained MLModel
+        """
+        from deltasherlock.server import queueing
 
+        if algorithm in (MLAlgorithm.nearest_neighbor, MLAlgorithm.sgd_logistic_regression):
+            raise ValueError("Only per-label algorithms can be trained distributed")
+        method = fingerprints[0].method
         for fingerprint in fingerprints:
-            self.__labels.append(fingerprint.labels)
-            self.labels += fingerprint.labels
+            if fingerprint.method != method:
+                raise ValueError("Models can only be trained with one fingerprinting method at a time")
+        if queue is None:
+            queue = queueing.get_queue()
+        if timeout is None:
+            timeout = queueing.DEFAULT_TIMEOUT
+
+        model = cls.__new__(cls)
+        model.__setup(algorithm, method, params=params)
+        label_lists = [fingerprint.labels for fingerprint in fingerprints]
+        model.num_fingerprints = len(fingerprints)
+        model.label_counts = Counter()
+        for labels in label_lists:
+            model.label_counts.update(labels)
+        y = model.binarizer.fit_transform(label_lists)
+
+        # Mirror what OneVsRestClassifier.fit() would have set up
+        classifier = model.classifier
+        classifier.label_binarizer_ = preprocessing.LabelBinarizer(sparse_output=True)
+        classifier.label_binarizer_.fit(y)
+        classifier.classes_ = classifier.label_binarizer_.classes_
+
+        os.makedirs(work_path, exist_ok=True)
+        run_path = tempfile.mkdtemp(prefix="train-", dir=work_path)
+        try:
+            matrix_path = os.path.join(run_path, "X.npy")
+            labels_path = os.path.join(run_path, "Y.npz")
+            np.save(matrix_path, fingerprint_matrix(fingerprints))
+            sparse.save_npz(labels_path, sparse.csc_matrix(y))
+
+            jobs = []
+            for start in range(0, y.shape[1], labels_per_job):
+                columns = list(range(start, min(start + labels_per_job, y.shape[1])))
+                jobs.append(queue.enqueue(fit_label_chunk, matrix_path, labels_path,
+                                          columns, algorithm.value, run_path, params,
+                                          job_timeout=timeout))
+
+            classifier.estimators_ = []
+            for chunk_path in queueing.collect_results(jobs, timeout):
+                with open(chunk_path, "rb") as chunk_file:
+                    classifier.estimators_ += pickle.load(chunk_file)
+        finally:
+            shutil.rmtree(run_path, ignore_errors=True)
+
+        if hasattr(classifier.estimators_[0], "n_features_in_"):
+            classifier.n_features_in_ = classifier.estimators_[0].n_features_in_
+        return model
+
+    def __setup(self, algorithm: MLAlgorithm, method, n_jobs: int = None,
+                params: dict = None):
+        """
+        Create the (untrained) estimator, classifier, and binarizer
+        """
+        self.method = method
+        self.algorithm = algorithm
+        self.params = params
+        self.model = MLModel.create_estimator(algorithm, params)
+
+        # Setup ML Resources. Labels are kept as a sparse matrix, since each
+        # fingerprint only has a handful of the (potentially thousands of) labels
+        if isinstance(self.model, (NearestNeighborClassifier, OnlineClassifier)):
+            # Already multi-label, so there's nothing to split per label
+            self.classifier = self.model
+        else:
+            self.classifier = OneVsRestClassifier(self.model, n_jobs=n_jobs)
+        self.binarizer = preprocessing.MultiLabelBinarizer(sparse_output=True)
+
+    def __fit(self, X, label_lists: list):
+        """
+        Train the classifier on a NaN-free 2-D array of fingerprints
+        """
+        self.num_fingerprints = X.shape[0]
 
-        X = np.nan_to_num(np.array(fingerprints))
-        y = self.binarizer.fit_transform(self.__labels)
+        # How many training fingerprints carry each label
+        self.label_counts = Counter()
+        for labels in label_lists:
+            self.label_counts.update(labels)
+
+        y = self.binarizer.fit_transform(label_lists)
         self.classifier.fit(X, y)
 
-    def predict(self, fingerprint: Fingerprint, override_quantity = None):
-        prediction = None
+    def __extend_labels(self, label_lists: list):
+        """
+        Record the labels of new fingerprints, adding any unseen labels to the
+        binarizer (and moving the classifier's existing classes to match)
+
+        :param label_lists: a list containing the list of labels of each new
+        fingerprint
+        :returns: the binary label matrix of the new fingerprints
+        """
+        old_classes = self.binarizer.classes_
+        for labels in label_lists:
+            self.label_counts.update(labels)
+
+        new_labels = set(label for labels in label_lists for label in labels)
+        if not new_labels.issubset(old_classes):
+            self.binarizer.fit([list(old_classes) + list(new_labels)])
+            self.classifier.remap_classes(
+                np.searchsorted(self.binarizer.classes_, old_classes),
+                len(self.binarizer.classes_))
+
+        return self.binarizer.transform(label_lists)
+
+    def add(self, fingerprints: list):
+        """
+        Add labeled fingerprints to a nearest_neighbor model without retraining.
+        New labels are supported
 
-        # get the class probabilities
-        probabilities = self.classifier.predict_proba(
-            fingerprint.reshape(1, -1))
+        :param fingerprints: the list of labeled Fingerprints to be added
+        """
+        if self.algorithm != MLAlgorithm.nearest_neighbor:
+            raise ValueError("Only nearest_neighbor models can be added to without retraining")
+        self.update(fingerprints)
+
+    def update(self, fingerprints: list):
+        """
+        Keep training a nearest_neighbor or sgd_logistic_regression model with
+        new labeled fingerprints, at a fraction of the cost of retraining from
+        scratch. New labels are supported
+
+        :param fingerprints: the list of labeled Fingerprints to be learned
+        """
+        if not isinstance(self.classifier, (NearestNeighborClassifier, OnlineClassifier)):
+            raise ValueError("Only nearest_neighbor and sgd_logistic_regression models can be updated")
+        for fingerprint in fingerprints:
+            if fingerprint.method != self.method:
+                raise ValueError("Models can only be trained with one fingerprinting method at a time")
+
+        X = fingerprint_matrix(fingerprints)
+        y = self.__extend_labels([fingerprint.labels for fingerprint in fingerprints])
+        if isinstance(self.classifier, NearestNeighborClassifier):
+            self.classifier.add(X, y)
+        else:
+            self.classifier.partial_fit(X, y)
+        self.num_fingerprints += len(fingerprints)
+
+    def export_compact(self, save_path: str):
+        """
+        Save a linear model (logistic_regression, svm_linear, or
+        sgd_logistic_regression) as a NumPy .npz archive of its coefficients,
+        intercepts, and label classes. The result can be loaded and predicted
+        against by serving.CompactModel without sklearn, giving the same results
+        as predict()
+
+        :param save_path: the path of the .npz file to be written
+        """
+        if isinstance(self.classifier, OnlineClassifier):
+            estimators = self.classifier.estimators_
+            threshold = 0.0
+        elif self.algorithm in (MLAlgorithm.logistic_regression, MLAlgorithm.svm_linear):
+            estimators = self.classifier.estimators_
+            # Matches the threshold OneVsRestClassifier.predict() picks
+            threshold = 0.0 if (hasattr(estimators[0], "decision_function")
+                                and is_classifier(estimators[0])) else 0.5
+        else:
+            raise ValueError("Only linear models can be exported")
 
+        coefs = np.zeros((len(estimators), self.classifier.n_features_in_))
+        intercepts = np.zeros(len(estimators))
+        for index, estimator in enumerate(estimators):
+            if hasattr(estimator, "coef_"):
+                coefs[index] = estimator.coef_.ravel()
+                intercepts[index] = np.ravel(estimator.intercept_)[0]
+            else:
+                # A label present in all (or none) of the training fingerprints
+                # is predicted regardless of the input
+                intercepts[index] = np.inf if np.ravel(estimator.y_)[0] else -np.inf
+
+        classes = self.binarizer.classes_
+        if classes.dtype == object:
+            classes = np.array(list(classes))
+
+        with open(save_path, "wb") as output_file:
+            np.savez(output_file, coefs=coefs, intercepts=intercepts,
+                     classes=classes, threshold=threshold,
+                     # svm_linear has no probabilities, so rank by decision value
+                     probabilities=self.algorithm != MLAlgorithm.svm_linear,
+                     method=self.method.value, algorithm=self.algorithm.value,
+                     num_fingerprints=self.num_fingerprints)
+
+    def predict(self, fingerprint: Fingerprint, override_quantity = None):
+        """
+        Predict the labels of a single fingerprint. See predict_batch()
+
+        :param fingerprint: the Fingerprint to be predicted
+        :param override_quantity: the number of labels to predict, instead of
+        the fingerprint's predicted_quantity
+        :returns: a tuple of predicted labels
+        """
         qty = 0
         if override_quantity is None:
             qty = fingerprint.predicted_quantity
         else:
             qty = override_quantity
-        # Prevent wild quantity predictions from breaking everything
-        # TODO Don't hardcode 50
-        if qty > 0 and qty <= 50:
-            # get top n class probabilities
-            topNClasses = np.argpartition(probabilities[0], -qty)[-qty:]
-
-            # create a sparse array of 1's and 0's marking the label indices
-            prediction = np.zeros((1, self.classifier.classes_.shape[0]))
-            for index in topNClasses:
-                prediction[0][index] = 1
-        else:
+
+        return self.predict_batch(fingerprint.reshape(1, -1), [qty])[0]
+
+    def predict_batch(self, matrix, quantities: list = None) -> list:
+        """
+        Predict the labels of many fingerprints at once. When a row's quantity
+        is within (0, serving.MAX_QUANTITY], the labels of its top quantity
+        class probabilities (or decision values, for svm_linear)
+        are returned; otherwise the classifier's regular prediction is used.
+        Results are identical to calling predict() on each row, but the
+        classifier is only called once (or twice, if some rows fall back)
+
+        :param matrix: a list of Fingerprints, or a 2-D array with one
+        fingerprint per row
+        :param quantities: the number of labels to predict for each row. If
+        None, each Fingerprint's predicted_quantity is used
+        :returns: a list containing a tuple of predicted labels for each row
+        """
+        matrix, quantities, valid = prediction_inputs(matrix, quantities)
+
+        # create a sparse array of 1's and 0's marking the label indices
+        prediction = np.zeros((matrix.shape[0], self.classifier.classes_.shape[0]))
+
+        if valid.any():
+            # get the class probabilities
+            probabilities = self.__scores(matrix[valid])
+            valid_rows = np.flatnonzero(valid)
+            for rows, topNClasses in top_classes(probabilities, quantities[valid]):
+                prediction[valid_rows[rows][:, np.newaxis], topNClasses] = 1
+
+        if not valid.all():
             # Fall back to regular old prediction
-            prediction = self.classifier.predict(fingerprint.reshape(1, -1))
+            fallback = self.classifier.predict(matrix[~valid])
+            if sparse.issparse(fallback):
+                fallback = fallback.toarray()
+            prediction[~valid] = fallback
+
+        return self.binarizer.inverse_transform(prediction)
 
-        return self.binarizer.inverse_transform(prediction)[0]
+    def __scores(self, matrix):
+        """
+        Returns the score each class is ranked by: its probability, or for
+        svm_linear (which has none) its decision value, exactly as
+        serving.CompactModel ranks them
+        """
+        if hasattr(self.model, "predict_proba"):
+            return self.classifier.predict_proba(matrix)
+
+        scores = self.classifier.decision_function(matrix).reshape(matrix.shape[0], -1)
+        for index, estimator in enumerate(self.classifier.estimators_):
+            if not hasattr(estimator, "coef_"):
+                # A label present in all (or none) of the training fingerprints
+                scores[:, index] = np.inf if np.ravel(estimator.y_)[0] else -np.inf
+        return scores
 
     def __repr__(self):
 
         return ("<" + self.algorithm.name + " model trained on "
             + str(self.num_fingerprints) + " " + self.method.name
-            + " fingerprints and " + str(len(set(self.labels))) + " unique labels>")
+            + " fingerprints and " + str(len(self.label_counts)) + " unique labels>")
+
+    def __setstate__(self, state):
+        # Models pickled before label_counts existed kept every label occurrence
+        state.setdefault('params', None)
+        if 'label_counts' not in state:
+            state['label_counts'] = Counter(state.pop('labels', []))
+            state.pop('_MLModel__labels', None)
+        self.__dict__.update(state)
+
+
+class CascadeModel(object):
+    """
+    A two-stage classifier for fingerprints that contain a histogram. A cheap
+    first-stage model, trained on the histogram slice alone, scores every
+    label. Its answer is used directly when it is confident enough; otherwise
+    it narrows the labels down to a few candidates, and only those candidates'
+    estimators of the (expensive) second-stage model are evaluated
+
+    :attribute threshold: the first-stage probability above which a label (or
+    below 1 - threshold, against which) is accepted without the second stage
+    :attribute num_candidates: the number of first-stage labels passed on to
+    the second stage
+    """
+
+    def __init__(self, fingerprints: list, algorithm: MLAlgorithm,
+                 first_stage_algorithm: MLAlgorithm = MLAlgorithm.logistic_regression,
+                 threshold: float = 0.9, num_candidates: int = 10,
+                 histogram_bins: int = 200, n_jobs: int = None):
+        """
+        Initialize and train both stages with a list of Fingerprints
+
+        :param fingerprints: the list of labeled training Fingerprints. Their
+        method must include a histogram
+        :param algorithm: the MLAlgorithm of the second stage
+        :param first_stage_algorithm: the MLAlgorithm of the first stage. Must
+        support probabilities
+        :param threshold: see threshold attribute
+        :param num_candidates: see num_candidates attribute
+        :param histogram_bins: the length of the histogram slice at the start of
+        each fingerprint
+        :param n_jobs: see MLModel.__init__()
+        """
+        method = fingerprints[0].method
+        if method.value % 2 != 1:
+            raise ValueError("Cascades require a fingerprinting method that includes a histogram")
+        for fingerprint in fingerprints:
+            if fingerprint.method != method:
+                raise ValueError("Models can only be trained with one fingerprinting method at a time")
+
+        self.method = method
+        self.threshold = threshold
+        self.num_candidates = num_candidates
+        self.histogram_bins = histogram_bins
+
+        X = fingerprint_matrix(fingerprints)
+        label_lists = [fingerprint.labels for fingerprint in fingerprints]
+        self.first_stage = MLModel.from_matrix(X[:, :histogram_bins], label_lists,
+                                               first_stage_algorithm, method, n_jobs)
+        self.second_stage = MLModel.from_matrix(X, label_lists, algorithm,
+                                                method, n_jobs)
+
+    @property
+    def num_fingerprints(self):
+        return self.second_stage.num_fingerprints
+
+    def predict(self, fingerprint: Fingerprint, override_quantity = None):
+        """
+        Predict the labels of a single fingerprint. See MLModel.predict()
+        """
+        qty = fingerprint.predicted_quantity if override_quantity is None else override_quantity
+        return self.predict_batch(fingerprint.reshape(1, -1), [qty])[0]
+
+    def predict_batch(self, matrix, quantities: list = None) -> list:
+        """
+        Predict the labels of many fingerprints at once. See
+        MLModel.predict_batch()
+        """
+        return self.__predict(matrix, quantities)[0]
+
+    def evaluate(self, fingerprints: list, thresholds: list = (0.5, 0.7, 0.9, 0.95, 0.99)) -> list:
+        """
+        Measure the latency/accuracy trade-off of each threshold on labeled
+        fingerprints, alongside the second stage on its own
+
+        :param fingerprints: the list of labeled test Fingerprints
+        :param thresholds: the thresholds to be tried
+        :returns: a list of dicts (one per threshold, then one for the second
+        stage alone with a threshold of None) containing the mean latency in
+        seconds of a single-fingerprint prediction, the fraction of
+        fingerprints that reached the second stage, and the exact-match accuracy
+        """
+        from time import perf_counter
+
+        def exact_match(predictions):
+            return float(np.mean([set(predicted) == set(fingerprint.labels)
+                                  for predicted, fingerprint in zip(predictions, fingerprints)]))
+
+        original_threshold = self.threshold
+        results = []
+        try:
+            for threshold in thresholds:
+                self.threshold = threshold
+                start = perf_counter()
+                for fingerprint in fingerprints:
+                    self.predict(fingerprint)
+                latency = (perf_counter() - start) / len(fingerprints)
+                predictions, second_stage_rows = self.__predict(fingerprints)
+                results.append({"threshold": threshold, "latency": latency,
+                                "second_stage_fraction": second_stage_rows / len(fingerprints),
+                                "exact_match": exact_match(predictions)})
+        finally:
+            self.threshold = original_threshold
+
+        start = perf_counter()
+        for fingerprint in fingerprints:
+            self.second_stage.predict(fingerprint)
+        latency = (perf_counter() - start) / len(fingerprints)
+        results.append({"threshold": None, "latency": latency,
+                        "second_stage_fraction": 1.0,
+                        "exact_match": exact_match(self.second_stage.predict_batch(fingerprints))})
+        return results
+
+    def __predict(self, matrix, quantities: list = None) -> tuple:
+        """
+        :returns: a tuple of the predictions and the number of rows that
+        needed the second stage
+        """
+        matrix, quantities, valid = prediction_inputs(matrix, quantities)
+
+        probabilities = self.first_stage.classifier.predict_proba(
+            matrix[:, :self.histogram_bins])
+        num_classes = probabilities.shape[1]
+        prediction = np.zeros(probabilities.shape, dtype=bool)
+        confident = np.zeros(matrix.shape[0], dtype=bool)
+
+        # With a quantity, the first stage is trusted when its top n labels
+        # are all likely enough
+        valid_rows = np.flatnonzero(valid)
+        for group, top in top_classes(probabilities[valid], quantities[valid]):
+            rows = valid_rows[group]
+            trusted = np.take_along_axis(probabilities[rows], top, axis=1).min(axis=1) >= self.threshold
+            prediction[rows[trusted][:, np.newaxis], top[trusted]] = True
+            confident[rows[trusted]] = True
+
+        # Without one, every label has to be clearly in or clearly out
+        rows = np.flatnonzero(~valid)
+        trusted = ((probabilities[rows] >= self.threshold)
+                   | (probabilities[rows] <= 1 - self.threshold)).all(axis=1)
+        prediction[rows[trusted]] = probabilities[rows[trusted]] >= self.threshold
+        confident[rows[trusted]] = True
+
+        rows = np.flatnonzero(~confident)
+        if rows.size:
+            k = self.num_candidates
+            if valid[rows].any():
+                k = max(k, quantities[rows][valid[rows]].max())
+            k = min(k, num_classes)
+            candidates = np.argpartition(probabilities[rows], -k, axis=1)[:, -k:]
+            columns = np.unique(candidates)
+
+            scores = np.full((rows.size, num_classes), -np.inf)
+            scores[:, columns] = self.__candidate_scores(matrix[rows], columns)
+            is_candidate = np.zeros(scores.shape, dtype=bool)
+            is_candidate[np.arange(rows.size)[:, np.newaxis], candidates] = True
+            scores[~is_candidate] = -np.inf
+
+            for index, row in enumerate(rows):
+                if valid[row]:
+                    qty = min(quantities[row], k)
+                    prediction[row, np.argpartition(scores[index], -qty)[-qty:]] = True
+                else:
+                    prediction[row] = scores[index] > 0.5
+
+        return (self.second_stage.binarizer.inverse_transform(prediction.astype(np.int64)),
+                rows.size)
+
+    def __candidate_scores(self, matrix, columns):
+        """
+        Returns the second-stage probability of each of the given label columns,
+        evaluating only their estimators where possible
+        """
+        classifier = self.second_stage.classifier
+        if not hasattr(classifier, 'estimators_'):
+            return classifier.predict_proba(matrix)[:, columns]
+
+        scores = np.empty((matrix.shape[0], len(columns)))
+        for index, column in enumerate(columns):
+            estimator = classifier.estimators_[column]
+            if hasattr(estimator, 'predict_proba'):
+                scores[:, index] = estimator.predict_proba(matrix)[:, 1]
+            else:
+                # ie. LinearSVC, whose decision values are mapped onto (0, 1)
+                scores[:, index] = expit(estimator.decision_function(matrix))
+        return scores
+
+    def __repr__(self):
+        return ("<cascade of " + self.first_stage.algorithm.name + " and "
+                + self.second_stage.algorithm.name + " models trained on "
+                + str(self.num_fingerprints) + " " + self.method.name
+                + " fingerprints and "
+                + str(len(self.second_stage.label_counts)) + " unique labels>")
+
+
+def fit_label_chunk(matrix_path: str, labels_path: str, columns: list,
+                    algorithm_value: int, save_path: str, params: dict = None) -> str:
+    """
+    Fit the binary classifiers of a few labels, exactly as OneVsRestClassifier
+    would. Intended for use as an RQ job (see MLModel.train_distributed())
+
+    :param matrix_path: the path of the .npy feature matrix, which is memory-mapped
+    :param labels_path: the path of the .npz sparse label matrix
+    :param columns: the label columns to be fitted
+    :param algorithm_value: the value of the MLAlgorithm to be used
+    :param save_path: the directory to save the fitted classifiers in
+    :param params: see MLModel.__init__()
+    :returns: the path of the pickled list of fitted classifiers
+    """
+    X = np.load(matrix_path, mmap_mode='r')
+    Y = sparse.load_npz(labels_path).tocsc()
+    prototype = MLModel.create_estimator(MLAlgorithm(algorithm_value), params)
+
+    estimators = []
+    for column in columns:
+        y = Y[:, column].toarray().ravel()
+        if np.unique(y).size == 1:
+            # The label is present in all (or none) of the fingerprints
+            estimators.append(ConstantPredictor().fit(X, y))
+        else:
+            estimators.append(clone(prototype).fit(X, y))
+
+    chunk_path = os.path.join(save_path, "labels_" + str(columns[0]) + ".pkl")
+    with open(chunk_path + ".partial", "wb") as chunk_file:
+        pickle.dump(estimators, chunk_file)
+    os.replace(chunk_path + ".partial", chunk_path)
+    return chunk_path
+
+
+def fingerprint_matrix(fingerprints: list, dtype=np.float32) -> np.ndarray:
+    """
+    Stack fingerprints into a single 2-D array, replacing NaNs and infinities
+    in place. Unlike np.nan_to_num(np.array(fingerprints)), no intermediate
+    copies of the (potentially huge) matrix are made
+
+    :param fingerprints: a list of Fingerprints of the same length
+    :param dtype: the dtype of the matrix
+    :returns: the matrix, with one fingerprint per row
+    """
+    matrix = np.empty((len(fingerprints), len(fingerprints[0]) if fingerprints else 0),
+                      dtype=dtype)
+    for row, fingerprint in enumerate(fingerprints):
+        matrix[row] = fingerprint
+    # Sanitize a block at a time, so nan_to_num's masks stay small too
+    for start in range(0, matrix.shape[0], 1024):
+        np.nan_to_num(matrix[start:start + 1024], copy=False)
+    return matrix
+
+
+def train_models(fingerprints: list, algorithms: list, method=None,
+                 n_jobs: int = None, model_n_jobs: int = None) -> list:
+    """
+    Train one MLModel per MLAlgorithm on the same fingerprints, several at a
+    time. The feature matrix is built once; joblib hands it to worker processes
+    as a read-only memory map rather than copying it into each one
+
+    :param fingerprints: the list of labeled training Fingerprints
+    :param algorithms: the list of MLAlgorithms to be trained
+    :param method: the FingerprintingMethod of the fingerprints. If None, the
+    method of the first fingerprint is used
+    :param n_jobs: the number of models to train at once. -1 means one per core
+    :param model_n_jobs: the n_jobs of each MLModel (see MLModel.__init__())
+    :returns: the list of trained MLModels, in the same order as algorithms
+    """
+    from joblib import Parallel, delayed
+
+    if method is None:
+        method = fingerprints[0].method
+    for fingerprint in fingerprints:
+        if fingerprint.method != method:
+            raise ValueError("Models can only be trained with one fingerprinting method at a time")
+
+    X = fingerprint_matrix(fingerprints)
+    label_lists = [fingerprint.labels for fingerprint in fingerprints]
+
+    return Parallel(n_jobs=n_jobs)(
+        delayed(MLModel.from_matrix)(X, label_lists, algorithm, method,
+                                     model_n_jobs)
+        for algorithm in algorithms)
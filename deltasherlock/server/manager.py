@@ -3,96 +3,147 @@ Contains methods for maintaining the fingerprint, changeset, and dictionary
 databases.
 """
 import os
-import time
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from deltasherlock.common import fingerprinting as fp
 from deltasherlock.common import dictionaries as dc
+from deltasherlock.common.io import object_digest
+from deltasherlock.common.quantization import QuantizedMatrix
+from deltasherlock.server import queueing
 from gensim.models.word2vec import Word2Vec
+import numpy as np
 
 
-def generate_fingerprints_parallel(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool = False) -> list:
+def generate_fingerprints_parallel(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool = False, normalizer=None, chunk_size: int = 100, queue=None) -> list:
     """
     Exactly like generate_fingerprints(), but parallelizes dictionary and
     fingerprint generation via RQ. All jobs submitted to the "manager" queue.
     Method will still block until all Fingerprints are generated
+
+    Dictionaries are saved to save_path by the jobs that create them, and
+    fingerprinting jobs only receive their path and content digest (so
+    save_path must be on storage shared with the workers). Each job
+    fingerprints a chunk of changesets, and workers cache loaded dictionaries
+    between jobs (see dictionaries.load_dictionary()). Note that RQ's default
+    worker forks for every job, which discards that cache; use a worker class
+    that doesn't fork (ie. rq.SimpleWorker) to benefit from it
+
+    :param chunk_size: the number of changesets fingerprinted per job
+    :param queue: the rq.Queue to submit jobs to. Defaults to the "manager"
+    queue on the local Redis server. Pass a queue backed by a stand-in like
+    fakeredis (optionally with is_async=False) to run without a Redis server
     """
-    from rq import Queue
-    from redis import Redis
-    redis_conn = Redis()
-    q = Queue('manager', connection=redis_conn, default_timeout=82800)
+    if queue is None:
+        queue = queueing.get_queue('manager')
 
     save_path = os.path.abspath(save_path)
     fingerprints = []
-    filetree_dict = None
-    filetree_dict_job = None
-    neighbor_dict = None
-    neighbor_dict_job = None
+    filetree_path = None
+    filetree_digest = None
+    neighbor_path = None
+    neighbor_digest = None
+    dict_jobs = {}
 
-    # Create req'd w2v dictionaries (or load from file)
+    if method is None or method == fp.FingerprintingMethod.undefined:
+        raise ValueError("Invalid fingerprinting method")
+
+    # Create req'd w2v dictionaries (or use existing files)
     if method.requires_filetree_dict():
-        if use_existing_dict and os.path.exists(save_path + "/filetree.dsdc"):
-            filetree_dict = Word2Vec.load(save_path + "/filetree.dsdc")
+        filetree_path = save_path + "/filetree.dsdc"
+        if use_existing_dict and os.path.exists(filetree_path):
+            filetree_digest = dc.dictionary_digest(filetree_path)
         else:
             all_filetree_sentences = []
             for changeset in changesets:
                 all_filetree_sentences += changeset.get_filetree_sentences()
             # Submit Job to RQ
-            filetree_dict_job = q.enqueue(
-                dc.create_dictionary, all_filetree_sentences)
+            dict_jobs['filetree'] = queue.enqueue(
+                dc.create_dictionary_file, all_filetree_sentences, filetree_path,
+                normalizer=normalizer)
 
     if method.requires_neighbor_dict():
-        if use_existing_dict and os.path.exists(save_path + "/neighbor.dsdc"):
-            neighbor_dict = Word2Vec.load(save_path + "/neighbor.dsdc")
+        neighbor_path = save_path + "/neighbor.dsdc"
+        if use_existing_dict and os.path.exists(neighbor_path):
+            neighbor_digest = dc.dictionary_digest(neighbor_path)
         else:
             all_neighbor_sentences = []
             for changeset in changesets:
                 all_neighbor_sentences += changeset.get_neighbor_sentences()
             # Submit Job to RQ
-            neighbor_dict_job = q.enqueue(
-                dc.create_dictionary, all_neighbor_sentences)
-
-    if method.requires_filetree_dict() and filetree_dict is None:
-        while filetree_dict_job.result is None:
-            # Block until completion
-            time.sleep(0.2)
-        filetree_dict = filetree_dict_job.result
-
-    if method.requires_neighbor_dict() and neighbor_dict is None:
-        while neighbor_dict_job.result is None:
-            # Block until completion
-            time.sleep(0.2)
-        neighbor_dict = neighbor_dict_job.result
-
-    # Now generate fingerprints (using RQ)
+            dict_jobs['neighbor'] = queue.enqueue(
+                dc.create_dictionary_file, all_neighbor_sentences, neighbor_path,
+                normalizer=normalizer)
+
+    # Block until both dictionaries are trained and saved
+    digests = dict(zip(dict_jobs.keys(),
+                       queueing.collect_results(list(dict_jobs.values()))))
+    filetree_digest = digests.get('filetree', filetree_digest)
+    neighbor_digest = digests.get('neighbor', neighbor_digest)
+
+    # Now generate fingerprints (using RQ), one job per chunk of changesets
     fingerprint_gen_jobs = []
-    for changeset in changesets:
-        job = q.enqueue(fp.changeset_to_fingerprint,
-                        changeset=changeset,
-                        method=method,
-                        filetree_dictionary=filetree_dict,
-                        neighbor_dictionary=neighbor_dict)
+    for i in range(0, len(changesets), chunk_size):
+        job = queue.enqueue(fingerprint_changesets,
+                            changesets=changesets[i:i + chunk_size],
+                            method=method,
+                            filetree_path=filetree_path,
+                            filetree_digest=filetree_digest,
+                            neighbor_path=neighbor_path,
+                            neighbor_digest=neighbor_digest)
         fingerprint_gen_jobs.append(job)
 
-    # Save the dictionaries to the specified location
-    if filetree_dict is not None:
-        filetree_dict.save(save_path + "/filetree.dsdc")
-    if neighbor_dict is not None:
-        neighbor_dict.save(save_path + "/neighbor.dsdc")
-
     # Now block until we collect all the new fingerprints back from RQ
-    while len(fingerprints) < len(fingerprint_gen_jobs):
-        for job in fingerprint_gen_jobs:
-            if job.result is not None:
-                fingerprints.append(job.result)
-        time.sleep(0.2)
+    for chunk_fingerprints in queueing.collect_results(fingerprint_gen_jobs):
+        fingerprints += chunk_fingerprints
 
     return fingerprints
 
 
-def generate_fingerprints(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool = False) -> list:
+def fingerprint_changesets(changesets: list, method: fp.FingerprintingMethod, filetree_path: str = None, filetree_digest: str = None, neighbor_path: str = None, neighbor_digest: str = None) -> list:
+    """
+    Fingerprints a chunk of changesets against dictionaries saved on disk.
+    Dictionaries are referenced by path and content digest and cached by the
+    calling process, so this is cheap to call repeatedly from RQ jobs or pool
+    workers
+
+    :param changesets: a list of closed Changesets
+    :param method: a FingerprintingMethod object
+    :param filetree_path: the path of the saved filetree dictionary, if required
+    :param filetree_digest: the expected digest of that dictionary
+    :param neighbor_path: the path of the saved neighbor dictionary, if required
+    :param neighbor_digest: the expected digest of that dictionary
+    :returns: the list of Fingerprints, in the same order as the changesets
+    """
+    filetree_dict = None
+    neighbor_dict = None
+    if filetree_path is not None:
+        filetree_dict = dc.load_dictionary(filetree_path, filetree_digest)
+    if neighbor_path is not None:
+        neighbor_dict = dc.load_dictionary(neighbor_path, neighbor_digest)
+
+    fingerprints = []
+    for changeset in changesets:
+        fingerprint = fp.changeset_to_fingerprint(changeset=changeset,
+                                                  method=method,
+                                                  filetree_dictionary=filetree_dict,
+                                                  neighbor_dictionary=neighbor_dict)
+        fingerprint.cs_db_id = changeset.db_id
+        fingerprints.append(fingerprint)
+    return fingerprints
+
+
+def generate_fingerprints(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool = False, normalizer=None, incremental: bool = False, resume: bool = False, checkpoint_interval: int = None, quantize: str = None) -> list:
     """
     Runs the entire fingerprint generation process, including saving
     dictionaries. Optionally parallelizes via RQ
 
+    Fresh dictionaries are saved to save_path as soon as they are built. If
+    checkpoint_interval is set, generated fingerprints are also checkpointed
+    to a FingerprintStore in save_path every checkpoint_interval changesets,
+    and if the run is interrupted, calling this again with resume=True only
+    fingerprints the changesets that weren't checkpointed yet
+
     :param changesets: a list of Changeset objects to be converted. Ensure each
     changeset has a db_id attribute if you'd like the resulting Fingerprints to
     be linked to their origins.
@@ -101,16 +152,149 @@ def generate_fingerprints(changesets: list, method: fp.FingerprintingMethod, sav
     should be saved
     :param use_existing_dict: if True and a dictionary file already exists in the
     save_path, use that instead of generating a fresh one
+    :param normalizer: an optional TokenNormalizer used when building fresh
+    dictionaries. Existing dictionaries keep the normalizer they were built with
+    :param incremental: if True, reuse the fingerprints in save_path's
+    FingerprintStore, and only fingerprint changesets that are new or have
+    changed since the last run.
+    Everything is refingerprinted whenever the dictionaries change, so this is
+    only useful in combination with use_existing_dict
+    :param resume: if True, pick up where an earlier (interrupted) run left off
+    by reusing its saved dictionaries and checkpointed fingerprints. Implies
+    both use_existing_dict and incremental
+    :param checkpoint_interval: flush newly generated fingerprints to
+    save_path after this many changesets, so that little work is lost if the
+    run is interrupted. If None, nothing is stored unless incremental or
+    resuming, and then only once the run finishes
+    :param quantize: store checkpointed fingerprints as 'int8' or 'float16'
+    (see FingerprintStore). Returned fingerprints are never quantized
     """
     save_path = os.path.abspath(save_path)
     fingerprints = []
-    filetree_dict = None
-    neighbor_dict = None
+    store = None
 
     if method is None or method == fp.FingerprintingMethod.undefined:
         raise ValueError("Invalid fingerprinting method")
 
-    # Create req'd w2v dictionaries (or load from file)
+    if resume:
+        use_existing_dict = True
+        incremental = True
+
+    # Create req'd w2v dictionaries (or load from file). Fresh dictionaries
+    # are saved right away, so they survive an interrupted run
+    filetree_dict, neighbor_dict = _prepare_dictionaries(changesets, method,
+                                                         save_path,
+                                                         use_existing_dict,
+                                                         normalizer)
+
+    if incremental or checkpoint_interval is not None:
+        store = FingerprintStore(save_path, method,
+                                 _dictionaries_digest(save_path, method),
+                                 quantize=quantize)
+
+    # Now generate fingerprints
+    for changeset in changesets:
+        fingerprint = None
+        if store is not None:
+            key = FingerprintStore.changeset_key(changeset)
+            stamp = FingerprintStore.changeset_stamp(changeset)
+            vector = store.lookup(key, stamp) if incremental else None
+            if vector is not None:
+                fingerprint = _restore_fingerprint(vector, changeset, method)
+
+        if fingerprint is None:
+            fingerprint = fp.changeset_to_fingerprint(changeset=changeset,
+                                                      method=method,
+                                                      filetree_dictionary=filetree_dict,
+                                                      neighbor_dictionary=neighbor_dict)
+            if store is not None:
+                store.add(key, stamp, fingerprint)
+                if checkpoint_interval is not None and store.pending() >= checkpoint_interval:
+                    store.flush()
+        fingerprint.cs_db_id = changeset.db_id
+        fingerprints.append(fingerprint)
+
+    if store is not None:
+        # Forget changesets that are no longer part of the database
+        store.retain(FingerprintStore.changeset_key(changeset)
+                     for changeset in changesets)
+        store.compact()
+
+    return fingerprints
+
+
+def generate_fingerprints_multiprocess(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool = False, normalizer=None, workers: int = None, chunk_size: int = None) -> list:
+    """
+    Exactly like generate_fingerprints(), but parallelizes fingerprint
+    generation across a local process pool instead of RQ. Dictionaries are
+    saved to save_path first, then memory-mapped once by each worker process,
+    so only the changesets themselves are shipped with each task. Fingerprints
+    are returned in the same order as the changesets
+
+    :param workers: the number of worker processes (default: one per core)
+    :param chunk_size: the number of changesets fingerprinted per task
+    (default: enough for roughly four tasks per worker)
+    """
+    save_path = os.path.abspath(save_path)
+    fingerprints = []
+
+    if method is None or method == fp.FingerprintingMethod.undefined:
+        raise ValueError("Invalid fingerprinting method")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(changesets) // (workers * 4)))
+
+    # Create req'd w2v dictionaries (or load from file). The main process has
+    # no further use for them once they're safely on disk
+    filetree_dict, neighbor_dict = _prepare_dictionaries(changesets, method,
+                                                         save_path,
+                                                         use_existing_dict,
+                                                         normalizer)
+    filetree_path = None
+    filetree_digest = None
+    neighbor_path = None
+    neighbor_digest = None
+    if filetree_dict is not None:
+        filetree_path = save_path + "/filetree.dsdc"
+        filetree_digest = dc.dictionary_digest(filetree_path)
+    if neighbor_dict is not None:
+        neighbor_path = save_path + "/neighbor.dsdc"
+        neighbor_digest = dc.dictionary_digest(neighbor_path)
+    del filetree_dict, neighbor_dict
+
+    chunks = [changesets[i:i + chunk_size]
+              for i in range(0, len(changesets), chunk_size)]
+    chunk_task = partial(fingerprint_changesets, method=method,
+                         filetree_path=filetree_path,
+                         filetree_digest=filetree_digest,
+                         neighbor_path=neighbor_path,
+                         neighbor_digest=neighbor_digest)
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_fingerprint_pool,
+                             initargs=(filetree_path, filetree_digest,
+                                       neighbor_path, neighbor_digest)) as executor:
+        # map() yields results in submission order, regardless of which
+        # worker finishes first
+        for chunk_fingerprints in executor.map(chunk_task, chunks):
+            fingerprints += chunk_fingerprints
+
+    return fingerprints
+
+
+def _prepare_dictionaries(changesets: list, method: fp.FingerprintingMethod, save_path: str, use_existing_dict: bool, normalizer) -> tuple:
+    """
+    Creates (or loads from save_path) the w2v dictionaries required by method,
+    then saves any freshly created ones to save_path
+
+    :returns: a tuple of the filetree and neighbor dictionaries (either may be
+    None if not required by the method)
+    """
+    filetree_dict = None
+    neighbor_dict = None
+
     if method.requires_filetree_dict():
         if use_existing_dict and os.path.exists(save_path + "/filetree.dsdc"):
             filetree_dict = Word2Vec.load(save_path + "/filetree.dsdc")
@@ -118,7 +302,9 @@ def generate_fingerprints(changesets: list, method: fp.FingerprintingMethod, sav
             all_filetree_sentences = []
             for changeset in changesets:
                 all_filetree_sentences += changeset.get_filetree_sentences()
-            filetree_dict = dc.create_dictionary(all_filetree_sentences)
+            filetree_dict = dc.create_dictionary(all_filetree_sentences,
+                                                 normalizer=normalizer)
+            dc.save_dictionary(filetree_dict, save_path + "/filetree.dsdc")
 
     if method.requires_neighbor_dict():
         if use_existing_dict and os.path.exists(save_path + "/neighbor.dsdc"):
@@ -127,22 +313,346 @@ def generate_fingerprints(changesets: list, method: fp.FingerprintingMethod, sav
             all_neighbor_sentences = []
             for changeset in changesets:
                 all_neighbor_sentences += changeset.get_neighbor_sentences()
-            neighbor_dict = dc.create_dictionary(all_neighbor_sentences)
+            neighbor_dict = dc.create_dictionary(all_neighbor_sentences,
+                                                 normalizer=normalizer)
+            dc.save_dictionary(neighbor_dict, save_path + "/neighbor.dsdc")
 
-    # Now generate fingerprints
-    for changeset in changesets:
-        fingerprint = fp.changeset_to_fingerprint(changeset=changeset,
-                                                  method=method,
-                                                  filetree_dictionary=filetree_dict,
-                                                  neighbor_dictionary=neighbor_dict)
-        fingerprint.cs_db_id = changeset.db_id
-        fingerprints.append(fingerprint)
+    return filetree_dict, neighbor_dict
 
-    # Save the dictionaries to the specified location
-    if filetree_dict is not None:
-        filetree_dict.save(save_path + "/filetree.dsdc")
-    if neighbor_dict is not None:
-        neighbor_dict.save(save_path + "/neighbor.dsdc")
 
-    
-    return fingerprints
+def _init_fingerprint_pool(filetree_path: str, filetree_digest: str, neighbor_path: str, neighbor_digest: str):
+    """
+    Process pool initializer. Loads (and memory-maps) the saved dictionaries
+    once per worker, so that every task finds them in the process's cache
+    """
+    if filetree_path is not None:
+        dc.load_dictionary(filetree_path, filetree_digest)
+    if neighbor_path is not None:
+        dc.load_dictionary(neighbor_path, neighbor_digest)
+
+
+def _dictionaries_digest(save_path: str, method: fp.FingerprintingMethod) -> str:
+    """
+    Combines the content digests of every saved dictionary required by method
+    """
+    digests = []
+    if method.requires_filetree_dict():
+        digests.append(dc.dictionary_digest(save_path + "/filetree.dsdc"))
+    if method.requires_neighbor_dict():
+        digests.append(dc.dictionary_digest(save_path + "/neighbor.dsdc"))
+    return ":".join(digests)
+
+
+def _restore_fingerprint(vector: np.ndarray, changeset, method: fp.FingerprintingMethod) -> fp.Fingerprint:
+    """
+    Rebuilds the Fingerprint of a changeset from its stored vector, copying the
+    same attributes from the changeset as changeset_to_fingerprint() does
+    """
+    fingerprint = fp.Fingerprint(vector, method=method)
+    fingerprint.labels = changeset.labels
+    fingerprint.predicted_quantity = changeset.predicted_quantity
+    fingerprint.cs_db_id = changeset.db_id
+    return fingerprint
+
+
+class FingerprintStore(object):
+    """
+    On-disk store of the fingerprint vectors generated from a changeset
+    database, used to avoid refingerprinting changesets that haven't changed.
+    Consists of a JSON manifest (<method>.dsmf), a log of the changes made
+    since the manifest was written (<method>.<generation>.dslog), and a
+    directory of NumPy chunk files (<method>.dsfp/) within the save path. The
+    manifest records the method, the digest of the dictionaries used, and the
+    change stamp and vector location of each changeset. If the method or
+    dictionaries no longer match, the store starts out empty, which forces a
+    full rebuild
+
+    Each flush() writes one new chunk and appends one line to the log, so a
+    checkpoint costs the same no matter how large the store has grown.
+    compact() merges small chunks and folds the log back into the manifest;
+    call it once a run is finished
+
+    Chunks are .npy files of the exact vectors by default. If quantize is set,
+    new chunks are instead written as .npz files of int8 or float16 codes and
+    per-vector scales (see quantization.QuantizedMatrix), 4-8x smaller. Both
+    kinds of chunk can be read, so a store can switch between them at any time
+
+    :attribute method: the FingerprintingMethod of all stored vectors
+    :attribute dictionary_digest: the digest of the dictionaries used
+    :attribute quantize: None, 'int8', or 'float16'
+    :attribute entries: a dict mapping each changeset key to a list of its
+    change stamp, chunk number, and row within that chunk
+    :attribute generation: the number of the manifest, and of the log that
+    follows it
+    """
+    VERSION = 2
+    # compact() merges chunks with fewer live rows than this, into chunks of
+    # about this many rows
+    MERGE_ROWS = 65536
+
+    def __init__(self, save_path: str, method: fp.FingerprintingMethod, dictionary_digest: str, quantize: str = None):
+        save_path = os.path.abspath(save_path)
+        self.method = method
+        self.dictionary_digest = dictionary_digest
+        self.quantize = quantize
+        self.manifest_path = save_path + "/" + method.name + ".dsmf"
+        self.chunk_dir = save_path + "/" + method.name + ".dsfp"
+        self.entries = {}
+        self.next_chunk = 0
+        self.generation = 0
+        self.__log_prefix = save_path + "/" + method.name
+        self.__log_size = 0
+        self.__pending_keys = []
+        self.__pending_vectors = []
+        self.__dropped = []
+        self.__chunks = {}
+        # The log only applies to a manifest with the same method and
+        # dictionaries, so a mismatched (or missing) one is replaced first
+        self.__needs_manifest = True
+
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            manifest = None
+
+        if manifest is not None:
+            self.next_chunk = manifest['next_chunk']
+            # Version 1 manifests are the same, but never have a log
+            self.generation = manifest.get('generation', 0)
+            if (manifest['version'] in (1, self.VERSION)
+                    and manifest['method'] == method.value
+                    and manifest['dictionary_digest'] == dictionary_digest):
+                self.entries = manifest['entries']
+                self.__needs_manifest = False
+                self.__replay_log()
+
+    @staticmethod
+    def changeset_key(changeset) -> str:
+        """
+        Returns the key a changeset is stored under: its database ID if it has
+        one, otherwise its content digest
+        """
+        if changeset.db_id is not None:
+            return str(changeset.db_id)
+        return object_digest(changeset)
+
+    @staticmethod
+    def changeset_stamp(changeset) -> str:
+        """
+        Returns a cheap stamp that changes whenever a changeset does: its open
+        and close times and the number of each kind of record. Closed
+        changesets can't be modified, so unlike a content digest, there's no
+        need to encode every record
+
+        :param changeset: the (closed) Changeset
+        :returns: the stamp
+        """
+        return ":".join(str(value) for value in (
+            changeset.open_time, changeset.close_time, len(changeset.creations),
+            len(changeset.modifications), len(changeset.deletions)))
+
+    def lookup(self, key: str, stamp: str) -> np.ndarray:
+        """
+        Returns the stored vector for a changeset, or None if the changeset is
+        new or its change stamp no longer matches
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        chunk = self.__load_chunk(entry[1])
+        if isinstance(chunk, QuantizedMatrix):
+            return chunk[entry[2]].dequantize(np.float64)[0]
+        return np.array(chunk[entry[2]])
+
+    def add(self, key: str, stamp: str, vector: np.ndarray):
+        """
+        Adds (or replaces) the vector for a changeset. Not written to disk until
+        flush() is called
+        """
+        self.entries.pop(key, None)
+        self.__pending_keys.append((key, stamp))
+        self.__pending_vectors.append(np.asarray(vector))
+
+    def pending(self) -> int:
+        """
+        Returns the number of vectors added since the last flush()
+        """
+        return len(self.__pending_keys)
+
+    def retain(self, keys):
+        """
+        Drops every entry whose key is not in keys. Recorded on the next
+        flush(), and unreferenced chunk files are removed on the next compact()
+        """
+        keys = set(keys)
+        for key in [k for k in self.entries if k not in keys]:
+            del self.entries[key]
+            self.__dropped.append(key)
+        self.__pending_vectors = [vector for (key, _), vector
+                                  in zip(self.__pending_keys, self.__pending_vectors)
+                                  if key in keys]
+        self.__pending_keys = [pending for pending in self.__pending_keys
+                               if pending[0] in keys]
+
+    def flush(self):
+        """
+        Writes all pending vectors to a new chunk file, then appends a line
+        recording them (and any dropped entries) to the log
+        """
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        if self.__needs_manifest:
+            self.__write_manifest()
+
+        change = {'chunk': None, 'rows': [], 'drop': self.__dropped}
+        if self.__pending_vectors:
+            change['chunk'] = self.next_chunk
+            change['rows'] = self.__pending_keys
+            self.next_chunk += 1
+            self.__write_chunk(change['chunk'], self.__pending_vectors)
+            for row, (key, stamp) in enumerate(self.__pending_keys):
+                self.entries[key] = [stamp, change['chunk'], row]
+
+        if change['rows'] or change['drop']:
+            self.__append_log(change)
+        self.__pending_keys = []
+        self.__pending_vectors = []
+        self.__dropped = []
+
+    def compact(self):
+        """
+        Flushes, then merges chunks with few live rows into larger ones, writes
+        a fresh manifest (starting a new, empty log), and removes every chunk
+        file that is no longer referenced. Takes time in proportion to the size
+        of the store, so call it once a run is finished, not at every checkpoint
+        """
+        self.flush()
+
+        rows_by_chunk = {}
+        for key, (stamp, chunk, row) in self.entries.items():
+            rows_by_chunk.setdefault(chunk, []).append((key, stamp, row))
+        group = []
+        group_rows = 0
+        small = sorted(chunk for chunk, rows in rows_by_chunk.items()
+                       if len(rows) < self.MERGE_ROWS)
+        for index, chunk in enumerate(small):
+            group.append(chunk)
+            group_rows += len(rows_by_chunk[chunk])
+            if group_rows >= self.MERGE_ROWS or index == len(small) - 1:
+                if len(group) > 1:
+                    self.__merge_chunks(group, rows_by_chunk)
+                group = []
+                group_rows = 0
+
+        self.__write_manifest()
+
+    def __merge_chunks(self, chunks: list, rows_by_chunk: dict):
+        keys = []
+        vectors = []
+        for chunk in chunks:
+            rows = rows_by_chunk[chunk]
+            indices = [row for _, _, row in rows]
+            loaded = self.__load_chunk(chunk)
+            if isinstance(loaded, QuantizedMatrix):
+                vectors.append(loaded[indices].dequantize(np.float64))
+            else:
+                vectors.append(np.asarray(loaded[indices]))
+            keys += [(key, stamp) for key, stamp, _ in rows]
+
+        merged = self.next_chunk
+        self.next_chunk += 1
+        self.__write_chunk(merged, np.concatenate(vectors))
+        for row, (key, stamp) in enumerate(keys):
+            self.entries[key] = [stamp, merged, row]
+
+    def __write_chunk(self, chunk: int, vectors):
+        if self.quantize is None:
+            chunk_path = self.__chunk_path(chunk)
+            with open(chunk_path + ".tmp", 'wb') as chunk_file:
+                np.save(chunk_file, np.array(vectors))
+        else:
+            chunk_path = self.__chunk_path(chunk, ".npz")
+            QuantizedMatrix.quantize(vectors, self.quantize).save(chunk_path + ".tmp")
+        os.replace(chunk_path + ".tmp", chunk_path)
+
+    def __write_manifest(self):
+        """
+        Atomically replaces the manifest with one of the current entries, under
+        a new generation, then removes the old log and unreferenced chunks
+        """
+        old_log_path = self.__log_path()
+        self.generation += 1
+        manifest = {'version': self.VERSION,
+                    'method': self.method.value,
+                    'dictionary_digest': self.dictionary_digest,
+                    'next_chunk': self.next_chunk,
+                    'generation': self.generation,
+                    'entries': self.entries}
+        if os.path.exists(self.__log_path()):
+            # Left by an interrupted run; it belongs to no manifest
+            os.remove(self.__log_path())
+        with open(self.manifest_path + ".tmp", 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.__needs_manifest = False
+        self.__log_size = 0
+        if os.path.exists(old_log_path):
+            os.remove(old_log_path)
+
+        # Clean up chunks that are no longer referenced
+        referenced = set(entry[1] for entry in self.entries.values())
+        for fname in os.listdir(self.chunk_dir):
+            if fname[-4:] in (".npy", ".npz") and int(fname[:-4]) not in referenced:
+                os.remove(self.chunk_dir + "/" + fname)
+                self.__chunks.pop(int(fname[:-4]), None)
+
+    def __append_log(self, change: dict):
+        log_path = self.__log_path()
+        if os.path.exists(log_path) and os.path.getsize(log_path) != self.__log_size:
+            # Drop a line left incomplete by an interrupted flush
+            os.truncate(log_path, self.__log_size)
+        line = (json.dumps(change) + "\n").encode('utf-8')
+        with open(log_path, 'ab') as log_file:
+            log_file.write(line)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        self.__log_size += len(line)
+
+    def __replay_log(self):
+        try:
+            log_file = open(self.__log_path(), 'rb')
+        except IOError:
+            return
+        with log_file:
+            for line in log_file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete log line")
+                    change = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # An interrupted flush; its chunk is never referenced
+                    break
+                for key in change['drop']:
+                    self.entries.pop(key, None)
+                if change['chunk'] is not None:
+                    for row, (key, stamp) in enumerate(change['rows']):
+                        self.entries[key] = [stamp, change['chunk'], row]
+                    self.next_chunk = max(self.next_chunk, change['chunk'] + 1)
+                self.__log_size += len(line)
+
+    def __log_path(self) -> str:
+        return self.__log_prefix + "." + str(self.generation) + ".dslog"
+
+    def __chunk_path(self, chunk: int, extension: str = ".npy") -> str:
+        return self.chunk_dir + "/" + str(chunk) + extension
+
+    def __load_chunk(self, chunk: int):
+        if chunk not in self.__chunks:
+            if os.path.exists(self.__chunk_path(chunk)):
+                self.__chunks[chunk] = np.load(self.__chunk_path(chunk), mmap_mode='r')
+            else:
+                self.__chunks[chunk] = QuantizedMatrix.load(self.__chunk_path(chunk, ".npz"))
+        return self.__chunks[chunk]
+
+    def __len__(self):
+        return len(self.entries) + len(self.__pending_keys)
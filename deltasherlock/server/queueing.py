@@ -0,0 +1,52 @@
+# DeltaSherlock. See README.md for usage. See LICENSE for MIT/X11 license info.
+"""
+DeltaSherlock server queueing module. Contains helpers for submitting work to
+RQ queues and collecting the results
+"""
+from time import time
+
+# Matches the default timeout used by the "manager" queue
+DEFAULT_TIMEOUT = 82800
+
+
+def get_queue(name: str = 'manager', connection=None, timeout: int = DEFAULT_TIMEOUT):
+    """
+    Returns an RQ queue. Provide a connection (ie. a fakeredis.FakeStrictRedis)
+    to use something other than the default local Redis server
+
+    :param name: the name of the queue
+    :param connection: a Redis connection, or None for the default Redis()
+    :param timeout: the default job timeout in seconds
+    :returns: the rq.Queue object
+    """
+    from rq import Queue
+    from redis import Redis
+    if connection is None:
+        connection = Redis()
+    return Queue(name, connection=connection, default_timeout=timeout)
+
+
+def collect_results(jobs: list, timeout: int = DEFAULT_TIMEOUT) -> list:
+    """
+    Blocks until every job has finished, then returns their results in the same
+    order as the jobs. Rather than polling, this waits on each job's result
+    stream in Redis, so jobs that have already finished return immediately
+
+    :param jobs: a list of rq.job.Job objects
+    :param timeout: the maximum number of seconds to wait for all jobs
+    :returns: the list of job return values
+    :raises RuntimeError: if any job fails or the timeout expires
+    """
+    from rq.results import Result
+
+    results = []
+    deadline = time() + timeout
+    for job in jobs:
+        remaining = max(1, int(deadline - time()))
+        result = job.latest_result(timeout=remaining)
+        if result is None:
+            raise RuntimeError("Timed out waiting for job " + job.id)
+        if result.type != Result.Type.SUCCESSFUL:
+            raise RuntimeError("Job " + job.id + " failed:\n" + str(result.exc_string))
+        results.append(result.return_value)
+    return results
@@ -0,0 +1,787 @@
+# DeltaSherlock. See README.md for usage. See LICENSE for MIT/X11 license info.
+"""
+DeltaSherlock server serving module. Contains helpers for keeping trained
+models loaded between prediction jobs, a NumPy-only predictor for models
+exported with MLModel.export_compact(), a cache of prediction results, and a
+registry for swapping models without restarting workers
+"""
+import os
+import json
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Event, Lock, Thread
+from time import time
+import numpy as np
+from deltasherlock.common.fingerprinting import FingerprintingMethod
+
+# Extension of models exported with MLModel.export_compact()
+COMPACT_EXTENSION = ".npz"
+
+# Predicted quantities above this are ignored (see MLModel.predict_batch())
+MAX_QUANTITY = 50
+
+# Models saved without a method suffix are used for any method lacking its own
+DEFAULT_MODEL_PATH = "/tmp/DS_MLModel"
+
+# Where ModelRegistry keeps its versioned models by default
+DEFAULT_REGISTRY_PATH = "/tmp/DS_MLModels"
+
+
+# Extension of the file saved alongside a model recording its content digest
+VERSION_EXTENSION = ".sha256"
+
+# Content digests of model files, keyed by path, mtime, and size, so that
+# unchanged files are only ever hashed once per process
+_version_cache = {}
+
+
+def prediction_inputs(matrix, quantities: list = None) -> tuple:
+    """
+    Normalizes the arguments of a batch prediction (see
+    MLModel.predict_batch())
+
+    :param matrix: a list of Fingerprints, or a 2-D array with one fingerprint
+    per row
+    :param quantities: the number of labels to predict for each row. If None,
+    each Fingerprint's predicted_quantity is used
+    :returns: a tuple of the 2-D matrix, an array of quantities (with None as
+    0), and a boolean array marking the rows whose quantity is within
+    (0, MAX_QUANTITY], since wild quantity predictions would break everything
+    """
+    if quantities is None:
+        quantities = [getattr(row, 'predicted_quantity', 0) for row in matrix]
+    matrix = np.asarray(matrix)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    quantities = np.array([0 if qty is None else qty for qty in quantities],
+                          dtype=np.int64)
+    if quantities.shape[0] != matrix.shape[0]:
+        raise ValueError("Expected one quantity per row")
+    return matrix, quantities, (quantities > 0) & (quantities <= MAX_QUANTITY)
+
+
+def top_classes(scores, quantities):
+    """
+    Finds the highest scoring classes of each row. Rows sharing a quantity get
+    their top classes from a single argpartition call
+
+    :param scores: a (rows, classes) array of scores
+    :param quantities: the number of classes to be found for each row
+    :returns: a generator of (rows, columns) tuples: the indices of a group of
+    rows, and a (len(rows), quantity) array of the top columns of each
+    """
+    for qty in np.unique(quantities):
+        rows = np.flatnonzero(quantities == qty)
+        yield rows, np.argpartition(scores[rows], -qty, axis=1)[:, -qty:]
+
+
+def model_version(path: str) -> str:
+    """
+    Returns a string identifying the current contents of a model file: a
+    SHA-256 digest of the file, so the same model has the same version on every
+    host, wherever it is saved. The digest is read from the file's version file
+    (path + VERSION_EXTENSION), as written by ModelRegistry.publish() or by an
+    earlier call. The model is only hashed if that file is missing or was
+    written for an older mtime or size, and then the version file is saved so
+    that other processes don't have to hash it again
+
+    :param path: the path of the model file
+    :returns: the version string
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _version_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        with open(path + VERSION_EXTENSION, 'r') as version_file:
+            saved = json.load(version_file)
+        digest = saved['sha256'] if (saved['mtime_ns'], saved['size']) == stamp else None
+    except (IOError, ValueError, KeyError, TypeError):
+        digest = None
+    if digest is None:
+        digest = save_model_version(path)
+    _version_cache[path] = (stamp, digest)
+    return digest
+
+
+def save_model_version(path: str) -> str:
+    """
+    Hash a model file and save its digest to its version file (see
+    model_version()). Failing to save it (ie. to a read-only directory) is not
+    an error, since the digest can always be recomputed
+
+    :param path: the path of the model file
+    :returns: the hex digest
+    """
+    stat = os.stat(path)
+    digest = sha256()
+    with open(path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b''):
+            digest.update(block)
+
+    version_path = path + VERSION_EXTENSION
+    try:
+        with open(version_path + ".partial", 'w') as version_file:
+            json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                       'sha256': digest.hexdigest()}, version_file)
+        os.replace(version_path + ".partial", version_path)
+    except IOError:
+        pass
+    return digest.hexdigest()
+
+
+def model_path(method: FingerprintingMethod = None, base_path: str = DEFAULT_MODEL_PATH,
+               registry=None) -> str:
+    """
+    Returns the path of the model to be used for fingerprints of the given
+    method. If a registry is provided and has an active model for the method,
+    that model is used. Otherwise, a per-method model (ie. "/tmp/DS_MLModel7"
+    for combined) is used if one exists, or else the shared base_path. In
+    either case, a compact export (ie. "/tmp/DS_MLModel7.npz") is preferred
+    over the pickle
+
+    :param method: the FingerprintingMethod of the fingerprint to be predicted
+    :param base_path: the path of the shared model
+    :param registry: an optional ModelRegistry to be checked first
+    :returns: the path of the model file
+    """
+    if registry is not None:
+        path = registry.path_for_method(method)
+        if path is not None:
+            return path
+
+    candidates = [base_path]
+    if method is not None:
+        candidates.insert(0, base_path + str(method.value))
+    for path in candidates:
+        if os.path.exists(path + COMPACT_EXTENSION):
+            return path + COMPACT_EXTENSION
+        if os.path.exists(path):
+            return path
+    return base_path
+
+
+class CompactModel(object):
+    """
+    A linear model loaded from an MLModel.export_compact() archive. Predicts
+    with a single matrix product, giving the same results as the MLModel it was
+    exported from without needing sklearn (or unpickling anything)
+    """
+
+    def __init__(self, load_path: str):
+        with np.load(load_path, allow_pickle=False) as archive:
+            self.coefs = archive['coefs']
+            self.intercepts = archive['intercepts']
+            self.classes = archive['classes']
+            self.threshold = float(archive['threshold'])
+            self.probabilities = bool(archive['probabilities'])
+            self.method = FingerprintingMethod(int(archive['method']))
+            self.algorithm_value = int(archive['algorithm'])
+            self.num_fingerprints = int(archive['num_fingerprints'])
+
+    def decision_function(self, matrix):
+        """
+        :param matrix: a 2-D array with one fingerprint per row
+        :returns: a (rows, classes) array of decision values
+        """
+        with np.errstate(invalid='ignore'):
+            # Constant labels have infinite intercepts and all-zero coefficients
+            return np.asarray(matrix, dtype=np.float64).dot(self.coefs.T) + self.intercepts
+
+    def predict(self, fingerprint, override_quantity=None):
+        """
+        Predict the labels of a single fingerprint. See MLModel.predict()
+        """
+        qty = fingerprint.predicted_quantity if override_quantity is None else override_quantity
+        return self.predict_batch(np.asarray(fingerprint).reshape(1, -1), [qty])[0]
+
+    def predict_batch(self, matrix, quantities: list = None) -> list:
+        """
+        Predict the labels of many fingerprints at once. See
+        MLModel.predict_batch()
+        """
+        matrix, quantities, valid = prediction_inputs(matrix, quantities)
+
+        decisions = self.decision_function(matrix)
+        # Fall back to thresholding each label's decision value
+        prediction = decisions > self.threshold
+
+        if valid.any():
+            scores = decisions[valid]
+            if self.probabilities:
+                with np.errstate(over='ignore'):
+                    scores = 1 / (1 + np.exp(-scores))
+            valid_rows = np.flatnonzero(valid)
+            prediction[valid] = False
+            for rows, top in top_classes(scores, quantities[valid]):
+                prediction[valid_rows[rows][:, np.newaxis], top] = True
+
+        return [tuple(self.classes[row]) for row in prediction]
+
+    def __repr__(self):
+        return ("<compact model trained on " + str(self.num_fingerprints) + " "
+                + self.method.name + " fingerprints and "
+                + str(len(self.classes)) + " unique labels>")
+
+
+class ModelCache(object):
+    """
+    Keeps unpickled MLModels (or CompactModels, for paths ending in .npz) in
+    memory, keyed by path. A model is only loaded again when its file's mtime
+    or size changes, so saving a retrained model to the same path is picked up
+    by the next prediction.
+
+    Models are loaded under a lock of their own, so loading one model never
+    delays requests for another, and requests for an already cached model never
+    wait at all.
+
+    Note that the cache lives only as long as the process: a forking RQ Worker
+    starts every job in a fresh child, so workers have to be run as
+    SimpleWorkers (as swarm/worker_init.py does) to benefit from it
+    """
+
+    def __init__(self):
+        self.__models = {}
+        # path -> the Lock held while that path is being loaded
+        self.__load_locks = {}
+        self.__lock = Lock()
+
+    def get(self, path: str):
+        """
+        Returns the model saved at path, loading it only if it is not cached or
+        the file has changed since it was cached
+
+        :param path: the path to a pickled MLModel or a compact export
+        :returns: the MLModel or CompactModel
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.__models.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with self.__lock:
+            load_lock = self.__load_locks.setdefault(path, Lock())
+        with load_lock:
+            # Another thread may have loaded it while this one waited
+            cached = self.__models.get(path)
+            if cached is None or cached[0] != version:
+                if path.endswith(COMPACT_EXTENSION):
+                    cached = (version, CompactModel(path))
+                else:
+                    with open(path, "rb") as model_file:
+                        cached = (version, pickle.load(model_file))
+                with self.__lock:
+                    self.__models[path] = cached
+        return cached[1]
+
+    def get_for_method(self, method: FingerprintingMethod = None,
+                       base_path: str = DEFAULT_MODEL_PATH):
+        """
+        Returns the model to be used for fingerprints of the given method. See
+        model_path()
+
+        :param method: the FingerprintingMethod of the fingerprint to be predicted
+        :param base_path: the path of the shared model
+        :returns: the MLModel
+        """
+        return self.get(model_path(method, base_path))
+
+    def evict(self, path: str = None):
+        """
+        Drop a model from the cache, or every model if no path is provided
+
+        :param path: the path of the model to be dropped
+        """
+        with self.__lock:
+            if path is None:
+                self.__models.clear()
+                self.__load_locks.clear()
+            else:
+                self.__models.pop(os.path.abspath(path), None)
+                self.__load_locks.pop(os.path.abspath(path), None)
+
+    def __contains__(self, path: str):
+        return os.path.abspath(path) in self.__models
+
+    def __len__(self):
+        return len(self.__models)
+
+
+# The cache shared by every job run in this process
+MODEL_CACHE = ModelCache()
+
+
+class PredictionCache(object):
+    """
+    A bounded LRU cache of prediction results, so that identical fingerprints
+    (ie. from idle hosts, or the same package installed across a fleet) only
+    have to be predicted once. Keys combine the model's version (a digest of its
+    contents, see model_version()) with a hash of the fingerprint's values,
+    method, and quantity, so results from a replaced model are never returned,
+    and hosts serving the same model share results however their files are
+    named.
+
+    If a Redis connection (or a fakeredis.FakeStrictRedis) is provided, results
+    are also shared through it, so that every worker benefits from the others'
+    predictions. Redis entries are bounded by ttl rather than max_size
+
+    :attribute hits: the number of lookups answered from the cache
+    :attribute misses: the number of lookups that required a prediction
+    """
+
+    def __init__(self, max_size: int = 10000, connection=None,
+                 prefix: str = "ds:prediction:", ttl: int = 86400):
+        """
+        :param max_size: the maximum number of results kept in this process
+        :param connection: an optional Redis connection to share results through
+        :param prefix: prepended to every key stored in Redis
+        :param ttl: the number of seconds results are kept in Redis
+        """
+        self.max_size = max_size
+        self.connection = connection
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__results = OrderedDict()
+        self.__versions = {}
+        self.__lock = Lock()
+
+    def key(self, path: str, fingerprint, quantity: int = None) -> str:
+        """
+        Returns the cache key of a prediction. Also evicts every result of an
+        older version of the model at path
+
+        :param path: the path of the model used for the prediction
+        :param fingerprint: the Fingerprint to be predicted
+        :param quantity: the number of labels to be predicted, if overriding the
+        fingerprint's predicted_quantity
+        :returns: the key string
+        """
+        path = os.path.abspath(path)
+        version = model_version(path)
+        if quantity is None:
+            quantity = fingerprint.predicted_quantity
+
+        digest = sha256(np.ascontiguousarray(fingerprint, dtype=np.float64).tobytes())
+        digest.update(str(getattr(fingerprint, 'method', None)).encode())
+        digest.update(str(quantity).encode())
+
+        with self.__lock:
+            if self.__versions.get(path, version) != version:
+                stale = self.__versions[path] + ":"
+                for stale_key in [k for k in self.__results if k.startswith(stale)]:
+                    del self.__results[stale_key]
+            self.__versions[path] = version
+        return version + ":" + digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Look up a prediction, counting a hit or miss
+
+        :param key: the key returned by key()
+        :returns: the tuple of predicted labels, or None if not cached
+        """
+        with self.__lock:
+            result = self.__results.get(key)
+            if result is not None:
+                self.__results.move_to_end(key)
+
+        if result is None and self.connection is not None:
+            shared = self.connection.get(self.prefix + key)
+            if shared is not None:
+                result = tuple(json.loads(shared))
+                self.__store(key, result)
+
+        with self.__lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key: str, prediction):
+        """
+        Cache a prediction
+
+        :param key: the key returned by key()
+        :param prediction: the tuple of predicted labels
+        :returns: the prediction as cached, with NumPy scalars converted to
+        plain Python values (exactly as get() will return it)
+        """
+        prediction = tuple(label.item() if hasattr(label, 'item') else label
+                           for label in prediction)
+        self.__store(key, prediction)
+        if self.connection is not None:
+            self.connection.set(self.prefix + key, json.dumps(prediction), ex=self.ttl)
+        return prediction
+
+    def predict(self, fingerprint, model_cache=None, override_quantity: int = None,
+                base_path: str = DEFAULT_MODEL_PATH, registry=None):
+        """
+        Predict the labels of a fingerprint with the model for its method (see
+        model_path()), unless the result is already cached
+
+        :param fingerprint: the Fingerprint to be predicted
+        :param model_cache: the ModelCache to fetch the model from (default:
+        MODEL_CACHE)
+        :param override_quantity: see MLModel.predict()
+        :param base_path: the path of the shared model
+        :param registry: an optional ModelRegistry (see model_path())
+        :returns: the tuple of predicted labels, as plain Python values whether
+        or not it was cached
+        """
+        if model_cache is None:
+            model_cache = MODEL_CACHE
+        path = model_path(fingerprint.method, base_path, registry)
+        key = self.key(path, fingerprint, override_quantity)
+        prediction = self.get(key)
+        if prediction is None:
+            prediction = self.put(key, model_cache.get(path).predict(fingerprint,
+                                                                     override_quantity))
+        return prediction
+
+    def hit_rate(self) -> float:
+        """
+        Returns the fraction of lookups answered from the cache
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        """
+        Drop every result cached in this process, and reset the counters
+        """
+        with self.__lock:
+            self.__results.clear()
+            self.__versions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __store(self, key: str, prediction: tuple):
+        with self.__lock:
+            self.__results[key] = prediction
+            self.__results.move_to_end(key)
+            while len(self.__results) > self.max_size:
+                self.__results.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__results)
+
+
+# The prediction cache shared by every job run in this process. Set its
+# connection to share results between workers
+PREDICTION_CACHE = PredictionCache()
+
+
+class ModelRegistry(object):
+    """
+    Keeps every published model in its own immutable version directory
+    (ie. "/tmp/DS_MLModels/combined/<version>/model"), alongside a CURRENT file
+    naming the active version. Publishing never touches a file a worker might
+    be reading, and activating a version is a single atomic rename, so workers
+    never see a half-written model.
+
+    Each worker only switches to a newly activated version once it has been
+    loaded into its ModelCache and its version is known. The load happens on a background thread while
+    the previous version keeps being served, so no prediction waits on it (the
+    first version a worker serves is the exception: there is nothing to serve
+    until it has loaded). Predictions already running keep their reference to
+    the old model and finish on it.
+    Models are registered under the name of their FingerprintingMethod, or
+    under "default" to be used for any method lacking its own
+    """
+
+    # The name of the model used for methods without their own
+    DEFAULT_NAME = "default"
+
+    def __init__(self, root: str = DEFAULT_REGISTRY_PATH, model_cache=None):
+        """
+        :param root: the directory containing the registered models
+        :param model_cache: the ModelCache active models are loaded into
+        (default: MODEL_CACHE)
+        """
+        self.root = os.path.abspath(root)
+        self.model_cache = MODEL_CACHE if model_cache is None else model_cache
+        # name -> (CURRENT file stat, version, model path)
+        self.__active = {}
+        # name -> the model path being loaded in the background
+        self.__preloading = {}
+        self.__ready = {}
+        self.__callbacks = []
+        self.__lock = Lock()
+        self.__stop = Event()
+
+    def publish(self, model, name: str = DEFAULT_NAME, activate: bool = True) -> str:
+        """
+        Save a model as a new version
+
+        :param model: an MLModel (or other picklable model) to be pickled, or
+        the path of a saved model file (ie. from MLModel.export_compact()) to
+        be copied
+        :param name: the FingerprintingMethod name the model is for, or
+        "default"
+        :param activate: if True, make the new version active right away
+        :returns: the new version string
+        """
+        model_dir = os.path.join(self.root, name)
+        os.makedirs(model_dir, exist_ok=True)
+        version = str(int(time() * 1000))
+        while os.path.exists(os.path.join(model_dir, version)):
+            version = str(int(version) + 1)
+
+        # Build the version in a scratch directory, then move it into place
+        scratch = tempfile.mkdtemp(prefix=".publish-", dir=model_dir)
+        try:
+            if isinstance(model, str):
+                filename = "model" + (COMPACT_EXTENSION if model.endswith(COMPACT_EXTENSION) else "")
+                shutil.copyfile(model, os.path.join(scratch, filename))
+            else:
+                filename = "model"
+                with open(os.path.join(scratch, filename), "wb") as model_file:
+                    pickle.dump(model, model_file)
+            # Hash it now, rather than on the first prediction it serves
+            save_model_version(os.path.join(scratch, filename))
+            os.rename(scratch, os.path.join(model_dir, version))
+        except BaseException:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+
+        if activate:
+            self.activate(version, name)
+        return version
+
+    def activate(self, version: str, name: str = DEFAULT_NAME):
+        """
+        Make a published version the active one (ie. to roll back)
+
+        :param version: the version string returned by publish()
+        :param name: see publish()
+        """
+        if self.__model_file(name, version) is None:
+            raise ValueError("No " + name + " model version " + str(version))
+        pointer = os.path.join(self.root, name, "CURRENT")
+        with open(pointer + ".partial", "w") as pointer_file:
+            pointer_file.write(version)
+            pointer_file.flush()
+            os.fsync(pointer_file.fileno())
+        os.replace(pointer + ".partial", pointer)
+
+    def versions(self, name: str = DEFAULT_NAME) -> list:
+        """
+        Returns every published version of a model, oldest first
+        """
+        model_dir = os.path.join(self.root, name)
+        if not os.path.isdir(model_dir):
+            return []
+        return sorted((entry for entry in os.listdir(model_dir) if entry.isdigit()), key=int)
+
+    def current_version(self, name: str = DEFAULT_NAME) -> str:
+        """
+        Returns the version named by the CURRENT file (which this process might
+        not have switched to yet), or None if no version has been activated
+        """
+        try:
+            with open(os.path.join(self.root, name, "CURRENT")) as pointer_file:
+                return pointer_file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, name: str = DEFAULT_NAME, wait: bool = False) -> str:
+        """
+        Switch to the current version of a model once it has been loaded. Cheap
+        when nothing has changed. A changed version is loaded on a background
+        thread, and the previous version is returned until the load finishes
+
+        :param name: see publish()
+        :param wait: if True, load a changed version on this thread and switch
+        to it before returning. Always the case if no version is active yet
+        :returns: the path of the active model file, or None if there is none
+        """
+        try:
+            stat = os.stat(os.path.join(self.root, name, "CURRENT"))
+            pointer_stat = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+        active = self.__active.get(name)
+        if active is not None and active[0] == pointer_stat:
+            return active[2]
+
+        version = self.current_version(name)
+        path = self.__model_file(name, version)
+        if path is None:
+            # Keep serving the previous version
+            return None if active is None else active[2]
+        if active is None or wait:
+            self.__switch(name, pointer_stat, version, path)
+            return path
+
+        # Keep serving the previous version until the new one has loaded
+        with self.__lock:
+            start = self.__preloading.get(name) != path
+            self.__preloading[name] = path
+        if start:
+            Thread(target=self.__preload, args=(name, pointer_stat, version, path),
+                   name="ModelRegistry preload " + name, daemon=True).start()
+        return active[2]
+
+    def path_for_method(self, method: FingerprintingMethod = None) -> str:
+        """
+        Returns the path of the (loaded) active model for a method, falling
+        back to the default model. See refresh()
+
+        :param method: the FingerprintingMethod of the fingerprint to be predicted
+        :returns: the model path, or None if the registry has no suitable model
+        """
+        path = None
+        if method is not None:
+            path = self.refresh(method.name)
+        if path is None:
+            path = self.refresh(self.DEFAULT_NAME)
+        return path
+
+    def get(self, name: str = DEFAULT_NAME):
+        """
+        Returns the active model, switching to a newly activated version first
+
+        :param name: see publish()
+        :returns: the model, or None if no version has been activated
+        """
+        path = self.refresh(name)
+        return None if path is None else self.model_cache.get(path)
+
+    def active_version(self, name: str = DEFAULT_NAME) -> str:
+        """
+        Returns the version this process is currently serving, or None
+        """
+        active = self.__active.get(name)
+        return None if active is None else active[1]
+
+    def wait_until_ready(self, name: str = DEFAULT_NAME, timeout: float = None) -> bool:
+        """
+        Block until this process has loaded an active version of a model
+
+        :param name: see publish()
+        :param timeout: the maximum number of seconds to wait
+        :returns: True if ready, False if the timeout expired
+        """
+        with self.__lock:
+            ready = self.__ready.setdefault(name, Event())
+        return ready.wait(timeout)
+
+    def on_ready(self, callback):
+        """
+        Register a function to be called as callback(name, version) whenever
+        this process switches to a newly loaded version
+        """
+        with self.__lock:
+            self.__callbacks.append(callback)
+
+    def watch(self, names: list = None, interval: float = 5.0) -> Thread:
+        """
+        Start a daemon thread that periodically refreshes models, so new
+        versions are loaded before any prediction asks for them
+
+        :param names: the names to be watched (default: every registered name)
+        :param interval: the number of seconds between checks
+        :returns: the Thread
+        """
+        self.__stop.clear()
+
+        def watch_loop():
+            while not self.__stop.is_set():
+                for name in names or self.names():
+                    try:
+                        # Already in the background, so load on this thread
+                        self.refresh(name, wait=True)
+                    except Exception as error:
+                        print("Error: Could not refresh model " + name + ": " + str(error))
+                self.__stop.wait(interval)
+
+        thread = Thread(target=watch_loop, name="ModelRegistry watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_watching(self):
+        """
+        Stop any thread started by watch()
+        """
+        self.__stop.set()
+
+    def names(self) -> list:
+        """
+        Returns the names of every registered model
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(entry for entry in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, entry)))
+
+    def prune(self, name: str = DEFAULT_NAME, keep: int = 3):
+        """
+        Delete all but the newest few versions of a model. The current and
+        active versions are always kept
+
+        :param name: see publish()
+        :param keep: the number of newest versions to keep
+        """
+        protected = {self.current_version(name), self.active_version(name)}
+        for version in self.versions(name)[:-keep or None]:
+            if version not in protected:
+                shutil.rmtree(os.path.join(self.root, name, version), ignore_errors=True)
+
+    def __preload(self, name: str, pointer_stat: tuple, version: str, path: str):
+        try:
+            self.__switch(name, pointer_stat, version, path, background=True)
+        except Exception as error:
+            print("Error: Could not load model " + name + " version " + version + ": " + str(error))
+        finally:
+            with self.__lock:
+                if self.__preloading.get(name) == path:
+                    del self.__preloading[name]
+
+    def __switch(self, name: str, pointer_stat: tuple, version: str, path: str,
+                 background: bool = False):
+        """
+        Load a model (and its version, see PredictionCache.key()), then make it
+        the active one
+        """
+        self.model_cache.get(path)
+        model_version(path)
+        with self.__lock:
+            if background and self.__preloading.get(name) != path:
+                # A newer version was activated while this one loaded
+                return
+            previous = self.__active.get(name)
+            if previous is not None and previous[0] == pointer_stat:
+                # Already switched, by another thread
+                return
+            self.__active[name] = (pointer_stat, version, path)
+            self.__ready.setdefault(name, Event()).set()
+            callbacks = list(self.__callbacks)
+            if previous is not None and previous[2] != path:
+                self.model_cache.evict(previous[2])
+        for callback in callbacks:
+            callback(name, version)
+
+    def __model_file(self, name: str, version: str) -> str:
+        if not version:
+            return None
+        for filename in ("model" + COMPACT_EXTENSION, "model"):
+            path = os.path.join(self.root, name, version, filename)
+            if os.path.exists(path):
+                return path
+        return None
+
+
+# The registry checked by process_fingerprint before the fixed model paths
+REGISTRY = ModelRegistry()
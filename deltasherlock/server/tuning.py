@@ -0,0 +1,201 @@
+# DeltaSherlock. See README.md for usage. See LICENSE for MIT/X11 license info.
+"""
+DeltaSherlock server tuning module. Contains code for searching MLModel
+hyperparameters in parallel, using either a local process pool or RQ
+"""
+import os
+import json
+from hashlib import sha256
+from time import perf_counter
+import numpy as np
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from deltasherlock.common.fingerprinting import FingerprintingMethod
+from deltasherlock.server.learning import MLModel, MLAlgorithm, fingerprint_matrix
+
+
+def parameter_grid(grid: dict) -> list:
+    """
+    Returns every combination of the given parameter values
+
+    :param grid: a dict of parameter names to lists of values, ie.
+    {"C": [1, 100, 10000]}
+    :returns: a list of parameter dicts
+    """
+    return list(ParameterGrid(grid))
+
+
+def sample_parameters(distributions: dict, num_samples: int, seed: int = 0) -> list:
+    """
+    Returns random combinations of parameter values
+
+    :param distributions: a dict of parameter names to lists of values or
+    scipy.stats distributions, ie. {"C": scipy.stats.loguniform(1, 1e4)}
+    :param num_samples: the number of combinations to be drawn
+    :param seed: the seed for the random number generator
+    :returns: a list of parameter dicts
+    """
+    return list(ParameterSampler(distributions, num_samples, random_state=seed))
+
+
+def prepare_folds(fingerprints: list, work_path: str, folds: int = 3, seed: int = 0) -> str:
+    """
+    Split fingerprints into cross-validation folds and save each fold's train
+    and test matrices as .npy files, which every candidate memory-maps instead
+    of rebuilding. Folds are saved in a subdirectory named after a digest of
+    the fingerprints, labels, and split, so calling this again with the same
+    arguments reuses the saved folds
+
+    :param fingerprints: the list of labeled Fingerprints
+    :param work_path: a directory that every worker can read
+    :param folds: the number of folds
+    :param seed: the seed used to shuffle fingerprints into folds
+    :returns: the path of the fold directory
+    """
+    method = fingerprints[0].method
+    matrix = fingerprint_matrix(fingerprints)
+    label_lists = [list(fingerprint.labels) for fingerprint in fingerprints]
+    quantities = np.array([fingerprint.predicted_quantity for fingerprint in fingerprints],
+                          dtype=np.int64)
+
+    digest = sha256(matrix.tobytes())
+    digest.update(json.dumps([label_lists, quantities.tolist(), method.value,
+                              folds, seed], default=str).encode())
+    fold_path = os.path.join(work_path, "folds-" + digest.hexdigest()[:16])
+    manifest_path = os.path.join(fold_path, "folds.json")
+    if os.path.exists(manifest_path):
+        return fold_path
+
+    os.makedirs(fold_path, exist_ok=True)
+    order = np.random.RandomState(seed).permutation(len(fingerprints))
+    test_rows = np.array_split(order, folds)
+    manifest = {"method": method.value, "folds": []}
+    for fold, rows in enumerate(test_rows):
+        train_rows = np.sort(np.concatenate([other for index, other in enumerate(test_rows)
+                                             if index != fold]))
+        rows = np.sort(rows)
+        np.save(os.path.join(fold_path, str(fold) + "_train.npy"), matrix[train_rows])
+        np.save(os.path.join(fold_path, str(fold) + "_test.npy"), matrix[rows])
+        manifest["folds"].append({"train_labels": [label_lists[row] for row in train_rows],
+                                  "test_labels": [label_lists[row] for row in rows],
+                                  "test_quantities": quantities[rows].tolist()})
+
+    # Written last, so an interrupted run is never mistaken for a complete one
+    with open(manifest_path + ".partial", "w") as manifest_file:
+        json.dump(manifest, manifest_file, default=str)
+    os.replace(manifest_path + ".partial", manifest_path)
+    return fold_path
+
+
+def evaluate_candidate(fold_path: str, algorithm_value: int, params: dict, fold: int) -> dict:
+    """
+    Train a model with the given hyperparameters on one fold and evaluate it.
+    Intended for use as a process pool task or RQ job (see search())
+
+    :param fold_path: the fold directory returned by prepare_folds()
+    :param algorithm_value: the value of the MLAlgorithm to be used
+    :param params: the hyperparameters to be evaluated
+    :param fold: the index of the fold
+    :returns: a dict of the params, fold, training and prediction time in
+    seconds, exact-match ratio, and mean Jaccard similarity
+    """
+    with open(os.path.join(fold_path, "folds.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    fold_manifest = manifest["folds"][fold]
+    train = np.load(os.path.join(fold_path, str(fold) + "_train.npy"), mmap_mode='r')
+    test = np.load(os.path.join(fold_path, str(fold) + "_test.npy"), mmap_mode='r')
+
+    start = perf_counter()
+    model = MLModel.from_matrix(train, fold_manifest["train_labels"],
+                                MLAlgorithm(algorithm_value),
+                                FingerprintingMethod(manifest["method"]),
+                                params=params)
+    train_seconds = perf_counter() - start
+
+    start = perf_counter()
+    predictions = model.predict_batch(test, fold_manifest["test_quantities"])
+    predict_seconds = perf_counter() - start
+
+    exact = 0
+    jaccard = 0.0
+    for predicted, labels in zip(predictions, fold_manifest["test_labels"]):
+        predicted = set(str(label) for label in predicted)
+        actual = set(str(label) for label in labels)
+        exact += predicted == actual
+        jaccard += len(predicted & actual) / max(1, len(predicted | actual))
+
+    return {"params": params, "fold": fold, "train_seconds": train_seconds,
+            "predict_seconds": predict_seconds,
+            "exact_match": exact / len(predictions),
+            "jaccard": jaccard / len(predictions)}
+
+
+def search(fingerprints: list, algorithm: MLAlgorithm, candidates: list,
+           work_path: str, folds: int = 3, backend: str = "process",
+           workers: int = None, queue=None, timeout: int = None) -> list:
+    """
+    Cross-validate every candidate set of hyperparameters in parallel. Every
+    (candidate, fold) pair is evaluated independently, against fold matrices
+    that are built once (see prepare_folds())
+
+    :param fingerprints: the list of labeled Fingerprints
+    :param algorithm: the MLAlgorithm to be tuned
+    :param candidates: a list of parameter dicts (see parameter_grid() and
+    sample_parameters())
+    :param work_path: a directory that every worker can read and write
+    :param folds: the number of cross-validation folds
+    :param backend: "process" for a local process pool, or "rq" for an RQ queue
+    :param workers: the number of processes (process backend only). None
+    means one per core
+    :param queue: the rq.Queue to use (rq backend only; default:
+    queueing.get_queue())
+    :param timeout: the maximum number of seconds to wait (rq backend only)
+    :returns: a list of dicts (one per candidate, best mean exact-match first)
+    containing the params, the mean of each metric across folds, and the
+    per-fold results
+    """
+    fold_path = prepare_folds(fingerprints, work_path, folds)
+    tasks = [(fold_path, algorithm.value, params, fold)
+             for params in candidates for fold in range(folds)]
+
+    if backend == "process":
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fold_results = list(executor.map(evaluate_candidate, *zip(*tasks)))
+    elif backend == "rq":
+        from deltasherlock.server import queueing
+        if queue is None:
+            queue = queueing.get_queue()
+        if timeout is None:
+            timeout = queueing.DEFAULT_TIMEOUT
+        jobs = [queue.enqueue(evaluate_candidate, *task, job_timeout=timeout)
+                for task in tasks]
+        fold_results = queueing.collect_results(jobs, timeout)
+    else:
+        raise ValueError("Unknown search backend: " + str(backend))
+
+    results = []
+    for index, params in enumerate(candidates):
+        candidate_results = fold_results[index * folds:(index + 1) * folds]
+        result = {"params": params, "folds": candidate_results}
+        for metric in ("train_seconds", "predict_seconds", "exact_match", "jaccard"):
+            result[metric] = float(np.mean([fold_result[metric]
+                                            for fold_result in candidate_results]))
+        results.append(result)
+    results.sort(key=lambda result: result["exact_match"], reverse=True)
+    return results
+
+
+def time_accuracy_curve(results: list, metric: str = "exact_match") -> list:
+    """
+    Returns the candidates on the time-versus-accuracy frontier: every
+    candidate more accurate than all candidates that train faster than it
+
+    :param results: the list returned by search()
+    :param metric: the accuracy metric ("exact_match" or "jaccard")
+    :returns: a list of (train_seconds, accuracy, params) tuples, fastest first
+    """
+    curve = []
+    for result in sorted(results, key=lambda result: result["train_seconds"]):
+        if not curve or result[metric] > curve[-1][1]:
+            curve.append((result["train_seconds"], result[metric], result["params"]))
+    return curve
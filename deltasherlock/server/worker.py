@@ -250,11 +250,9 @@ def process_fingerprint(fingerprint_json_str: str, endpoint_url: str, client_ip:
     """
     Accepts fingerprints from the API and produces a prediction
     """
-    import pickle
     from time import time
     from deltasherlock.common.io import DSDecoder
-    from deltasherlock.common.fingerprinting import Fingerprint
-    from deltasherlock.server.learning import MLModel, MLAlgorithm
+    from deltasherlock.server.serving import PREDICTION_CACHE, REGISTRY
 
     error = None
     start_time = time()
@@ -280,12 +278,11 @@ def process_fingerprint(fingerprint_json_str: str, endpoint_url: str, client_ip:
         queue_item_id = q.id
         queue_item_submission_time = q.submission_time.timestamp()
 
-    # Basically, we have to load the model from file and predict against it
+    # Basically, we have to fetch the model (loading it from file only if it
+    # changed since the last job) and predict against it, unless an identical
+    # fingerprint was already predicted by the same model
     fingerprint = DSDecoder().decode(fingerprint_json_str)
-    model_path = "/tmp/DS_MLModel"  # + str(int(fingerprint.method))
-    model = pickle.load(open(model_path, "rb"))
-
-    prediction = model.predict(fingerprint)
+    prediction = PREDICTION_CACHE.predict(fingerprint, registry=REGISTRY)
 
     # TODO notify the endpoint IP!
     if endpoint_url is not None:
@@ -17,12 +17,14 @@ queues = networking.swarm_checkin()
 log = gethostname() + " successfully booted and checked-in at " + str(time())
 networking.swarm_submit_log(log=log, log_type='NT')
 
-# Now launch the RQ workers
+# Now launch the RQ workers. SimpleWorkers run every job in the worker process
+# itself rather than a forked child, so loaded models and dictionaries stay
+# cached between jobs
 log = gethostname() + " attached RQ workers to the following queues:\n"
 log_type = 'NT'
 for queue in queues:
-    run_res = run("rq worker --url http://redis.v-m.tech:6379 " + queue + " &",
-                  shell=True)
+    run_res = run("rq worker -w rq.SimpleWorker --url http://redis.v-m.tech:6379 "
+                  + queue + " &", shell=True)
     log += queue + " at " + str(time()) + " (RC: " + str(run_res.returncode) + ")\n"
 
     if run_res.returncode != 0:
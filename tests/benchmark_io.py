@@ -0,0 +1,79 @@
+"""
+DeltaSherlock IO Benchmark
+
+Compares the size and encode/decode speed of the JSON and binary changeset
+formats, the decode throughput of each record form, and the size
+and error of quantized binary fingerprints, using synthetic changesets and
+fingerprints (no filesystem activity required)
+"""
+# pylint: disable=C0103
+import sys
+import time
+import numpy as np
+from deltasherlock.common import io
+from deltasherlock.common.fingerprinting import Fingerprint, FingerprintingMethod
+
+
+def best_time(func, repeat=5):
+    """Returns the fastest of several runs of func, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+print("records    format   size (bytes)   encode (ms)   decode (ms)")
+for num_records in sizes:
+    changeset = io.random_changeset(num_records, seed=num_records,
+                                    labels=["apache2", "mysql-server"])
+
+    json_str = io.DSEncoder().encode(changeset)
+    assert io.DSDecoder().decode(json_str) == changeset
+    binary = io.object_to_binary(changeset)
+    assert io.binary_to_object(binary) == changeset
+
+    results = [("json", len(json_str.encode('utf-8')),
+                best_time(lambda: io.DSEncoder().encode(changeset)),
+                best_time(lambda: io.DSDecoder().decode(json_str))),
+               ("binary", len(binary),
+                best_time(lambda: io.object_to_binary(changeset)),
+                best_time(lambda: io.binary_to_object(binary)))]
+
+    for fmt, size, encode_time, decode_time in results:
+        print("{:<10} {:<8} {:>12}   {:>11.1f}   {:>11.1f}".format(
+            num_records, fmt, size, encode_time * 1000, decode_time * 1000))
+
+print("")
+print("records    records form   decode (records/s)")
+for num_records in sizes:
+    changeset = io.random_changeset(num_records, seed=num_records,
+                                    labels=["apache2", "mysql-server"])
+    total_records = (len(changeset.creations) + len(changeset.modifications)
+                     + len(changeset.deletions))
+    dict_str = io.DSEncoder().encode(changeset)
+    list_str = io.DSEncoder(compact_records=True).encode(changeset)
+
+    for form, json_str in [("dict", dict_str), ("list", list_str)]:
+        assert io.DSDecoder().decode(json_str) == changeset
+        elapsed = best_time(lambda: io.DSDecoder().decode(json_str))
+        print("{:<10} {:<14} {:>18.0f}".format(
+            num_records, form, total_records / elapsed))
+
+print("")
+print("length     quantize   size (bytes)   ratio   max error")
+for length in [200, 600, 2400]:
+    fingerprint = Fingerprint(np.random.RandomState(length).randn(length))
+    fingerprint.method = FingerprintingMethod.combined
+    fingerprint.labels = ["apache2"]
+    exact_size = len(io.object_to_binary(fingerprint))
+    for quantize in [None, "float16", "int8"]:
+        binary = io.object_to_binary(fingerprint, quantize)
+        error = np.abs(io.binary_to_object(binary) - fingerprint).max()
+        print("{:<10} {:<10} {:>12}   {:>5.2f}   {:>9.2g}".format(
+            length, str(quantize), len(binary), exact_size / len(binary), error))
@@ -0,0 +1,207 @@
+"""
+DeltaSherlock Learning Benchmark
+
+Trains every MLAlgorithm on fingerprints of every FingerprintingMethod, and
+reports training time, prediction throughput, peak memory, model size, and
+accuracy as JSON (so that results can be diffed between commits). Uses
+deterministic synthetic changesets, so no filesystem activity is required.
+
+Usage: python benchmark_learning.py [--changesets N] [--output results.json] ...
+"""
+# pylint: disable=C0103
+import argparse
+import json
+import pickle
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from deltasherlock.common import io
+from deltasherlock.common.fingerprinting import FingerprintingMethod
+from deltasherlock.server.learning import MLModel, MLAlgorithm
+from deltasherlock.server.manager import generate_fingerprints
+from deltasherlock.server.serving import CompactModel
+
+
+def labeled_changesets(num_changesets: int, num_labels: int, num_records: int,
+                       seed: int) -> list:
+    """
+    Create synthetic changesets, each labeled with one or two of num_labels
+    applications. The same arguments always produce the same changesets
+    """
+    rng = random.Random(seed)
+    label_pool = ["app" + str(i) for i in range(num_labels)]
+    changesets = []
+    for i in range(num_changesets):
+        labels = rng.sample(label_pool, 1 if rng.random() < 0.7 else 2)
+        changeset = io.random_changeset(num_records, seed=seed * 1000003 + i,
+                                        labels=labels)
+        changeset.db_id = i
+        changesets.append(changeset)
+    return changesets
+
+
+def accuracy(predictions: list, fingerprints: list) -> dict:
+    """
+    Returns the exact-match ratio and the mean Jaccard similarity between the
+    predicted and true label sets
+    """
+    exact = 0
+    jaccard = 0.0
+    for predicted, fingerprint in zip(predictions, fingerprints):
+        predicted = set(predicted)
+        actual = set(fingerprint.labels)
+        exact += predicted == actual
+        jaccard += len(predicted & actual) / max(1, len(predicted | actual))
+    return {"exact_match": exact / len(fingerprints),
+            "jaccard": jaccard / len(fingerprints)}
+
+
+def benchmark_algorithm(algorithm: MLAlgorithm, train: list, test: list,
+                        measure_memory: bool) -> dict:
+    """
+    Train and evaluate a single MLAlgorithm
+    """
+    result = {}
+    start = time.perf_counter()
+    model = MLModel(train, algorithm)
+    result["train_seconds"] = time.perf_counter() - start
+
+    if measure_memory:
+        # Tracing slows allocation down, so memory gets its own training run
+        tracemalloc.start()
+        MLModel(train, algorithm)
+        result["train_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result["model_bytes"] = len(pickle.dumps(model))
+
+    start = time.perf_counter()
+    predictions = model.predict_batch(test)
+    elapsed = time.perf_counter() - start
+    result["predict_per_second"] = len(test) / elapsed
+    result.update(accuracy(predictions, test))
+
+    # Same again, but as if quantity prediction were always right
+    oracle = model.predict_batch(test, [len(fingerprint.labels) for fingerprint in test])
+    result.update({key + "_true_quantity": value
+                   for key, value in accuracy(oracle, test).items()})
+
+    if algorithm in (MLAlgorithm.logistic_regression, MLAlgorithm.svm_linear,
+                     MLAlgorithm.sgd_logistic_regression):
+        result["compact_agreement"] = compact_agreement(model, test)
+    if algorithm in (MLAlgorithm.nearest_neighbor, MLAlgorithm.sgd_logistic_regression):
+        result.update(benchmark_update(algorithm, train, test))
+    return result
+
+
+def compact_agreement(model: MLModel, test: list) -> float:
+    """
+    Returns the fraction of fingerprints that the model's compact export
+    predicts exactly as the model itself does (which should always be 1.0),
+    with and without a quantity
+    """
+    with tempfile.TemporaryDirectory() as save_path:
+        model.export_compact(save_path + "/model.npz")
+        compact = CompactModel(save_path + "/model.npz")
+    agreed = 0
+    for quantities in (None, [0] * len(test)):
+        agreed += sum(expected == actual for expected, actual in
+                      zip(model.predict_batch(test, quantities),
+                          compact.predict_batch(test, quantities)))
+    return agreed / (2 * len(test))
+
+
+def benchmark_update(algorithm: MLAlgorithm, train: list, test: list) -> dict:
+    """
+    Train without one label, then update() the model with that label's
+    fingerprints. Learning a new label shouldn't cost accuracy on the old ones
+    """
+    new_label = sorted(set(label for fingerprint in train for label in fingerprint.labels))[-1]
+    old = [fingerprint for fingerprint in train if new_label not in fingerprint.labels]
+    new = [fingerprint for fingerprint in train if new_label in fingerprint.labels]
+    old_test = [fingerprint for fingerprint in test if new_label not in fingerprint.labels]
+
+    model = MLModel(old, algorithm)
+    before = accuracy(model.predict_batch(old_test), old_test)
+    start = time.perf_counter()
+    model.update(new)
+    result = {"update_seconds": time.perf_counter() - start}
+    after = accuracy(model.predict_batch(old_test), old_test)
+    result.update({key + "_old_labels_before_update": value for key, value in before.items()})
+    result.update({key + "_old_labels_after_update": value for key, value in after.items()})
+    result.update({key + "_after_update": value
+                   for key, value in accuracy(model.predict_batch(test), test).items()})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--changesets", type=int, default=120)
+    parser.add_argument("--labels", type=int, default=8)
+    parser.add_argument("--records", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--test-fraction", type=float, default=0.25)
+    parser.add_argument("--methods", nargs="*", default=None,
+                        help="FingerprintingMethod names (default: all)")
+    parser.add_argument("--algorithms", nargs="*", default=None,
+                        help="MLAlgorithm names (default: all)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the (slower) peak memory measurement")
+    parser.add_argument("--output", default=None,
+                        help="where to write the JSON results (default: stdout)")
+    args = parser.parse_args(argv)
+
+    methods = [FingerprintingMethod[name] for name in args.methods] if args.methods \
+        else [method for method in FingerprintingMethod
+              if method != FingerprintingMethod.undefined]
+    algorithms = [MLAlgorithm[name] for name in args.algorithms] if args.algorithms \
+        else [algorithm for algorithm in MLAlgorithm
+              if algorithm != MLAlgorithm.undefined]
+
+    changesets = labeled_changesets(args.changesets, args.labels, args.records,
+                                    args.seed)
+    num_test = max(1, int(len(changesets) * args.test_fraction))
+
+    results = []
+    for method in methods:
+        with tempfile.TemporaryDirectory() as save_path:
+            try:
+                start = time.perf_counter()
+                fingerprints = generate_fingerprints(changesets, method, save_path)
+                fingerprint_seconds = time.perf_counter() - start
+            except Exception as error:
+                # Skip every algorithm for this method, but keep going
+                results.append({"method": method.name, "error": repr(error)})
+                continue
+
+        train = fingerprints[:-num_test]
+        test = fingerprints[-num_test:]
+        for algorithm in algorithms:
+            result = {"method": method.name, "algorithm": algorithm.name,
+                      "fingerprint_seconds": fingerprint_seconds}
+            try:
+                result.update(benchmark_algorithm(algorithm, train, test,
+                                                  not args.no_memory))
+            except Exception as error:
+                result["error"] = repr(error)
+            results.append(result)
+            print(method.name, algorithm.name, "done", file=sys.stderr)
+
+    report = {"config": {"changesets": args.changesets, "labels": args.labels,
+                         "records": args.records, "seed": args.seed,
+                         "test_fraction": args.test_fraction,
+                         "numpy": np.__version__},
+              "results": results}
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as output_file:
+            print(output, file=output_file)
+
+
+if __name__ == "__main__":
+    main()